@@ -0,0 +1,225 @@
+import argparse, base64, glob, json, logging, math, os, random, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Lets us import the Lambda modules the same way the Lambda runtime does
+sys.path.append(".")
+sys.path.append("microservices/front_door")
+sys.path.append("microservices/staging_er7")
+
+# Drives the ingest path at a given concurrency and message mix, either against a deployed stack over HTTP or
+# offline by calling the front door and staging handlers directly with moto standing in for the AWS services.
+# Every message sent gets a unique control ID (MSH-10) so the front door does not reject it as a duplicate.
+STAGES = ['front_door', 'trigger', 'prepare', 'parse']
+SYNTHETIC_NAMES = ["DOE", "ROE", "SMITH", "JONES", "GARCIA", "NGUYEN", "KIM", "PATEL", "JOHN", "JANE", "ALEX", "SAM"]
+lock = threading.Lock()
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-s', '--stack-name', help="Stack to send messages to, runs offline when not given")
+  parser.add_argument('-m', '--messages', help="Glob of ER7 message files", default="messages/*.txt")
+  parser.add_argument('-x', '--mix', help="Weights per message file, e.g. adt01=3,lab02=1 (default: equal)")
+  parser.add_argument('-n', '--count', help="Number of messages to send", type=int, default=200)
+  parser.add_argument('-c', '--concurrency', help="Messages in flight at once", type=int, default=8)
+  parser.add_argument('--synthetic', help="Share of messages with randomized patient data", type=float, default=0.5)
+  parser.add_argument('--parse-engine', help="Parse engine when offline", choices=['hl7apy', 'native'], default='native')
+  parser.add_argument('--user', help="Writer user when sending to a stack", default="writer@example.com")
+  parser.add_argument('--password', help="Password of the writer user", default="3C{KWLrXieQ#")
+  parser.add_argument('-o', '--output', help="Write the results as JSON to this file")
+  parser.add_argument('-b', '--baseline', help="Compare with the JSON results of a previous run")
+  parser.add_argument('--seed', help="Random seed for the message mix", type=int, default=1)
+  args = parser.parse_args()
+
+  random.seed(args.seed)
+  samples = __load_samples(args.messages, args.mix)
+  msgs = [__get_variant(samples, i, args.synthetic) for i in range(args.count)]
+  timings = {stage: [] for stage in STAGES}
+  errors = {stage: 0 for stage in STAGES}
+
+  if args.stack_name: run = __run_deployed(args, timings, errors)
+  else: run = __run_offline(args, timings, errors)
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    list(executor.map(run, msgs))
+  elapsed = time.perf_counter() - start
+
+  results = {
+    'config': {'mode': 'deployed' if args.stack_name else 'offline', 'count': args.count,
+      'concurrency': args.concurrency, 'synthetic': args.synthetic, 'mix': args.mix or 'equal',
+      'parse_engine': None if args.stack_name else args.parse_engine},
+    'elapsed_s': round(elapsed, 3),
+    'throughput_msg_s': round(args.count / elapsed, 2),
+    'stages': {stage: __summarize(timings[stage], errors[stage], elapsed) for stage in STAGES if timings[stage]}
+  }
+
+  __print_results(results, __load_baseline(args.baseline))
+  if args.output:
+    with open(args.output, 'w') as f: json.dump(results, f, indent=2)
+    print("Results written to '{}'".format(args.output))
+
+# Offline: moto stands in for DynamoDB, SNS and S3, the staging pipeline stands in for the Step Function
+def __run_offline(args, timings, errors):
+  os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+  os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing')
+  from moto import mock_aws
+  mock_aws().start()
+  import boto3
+
+  table_name = 'load_test_received_message'
+  boto3.resource('dynamodb').create_table(
+    TableName=table_name,
+    AttributeDefinitions=[{'AttributeName': 'message_hash', 'AttributeType': 'S'}],
+    KeySchema=[{'AttributeName': 'message_hash', 'KeyType': 'HASH'}],
+    BillingMode='PAY_PER_REQUEST'
+  )
+  topic = boto3.client('sns').create_topic(Name='load_test')['TopicArn']
+  os.environ.update(table=table_name, topic=topic, staging_mode='in_process', parse_engine=args.parse_engine)
+  logging.disable(logging.CRITICAL) # The handlers log every message at INFO
+
+  import structure_index
+  structure_index.index_path = structure_index.write_index_files(tempfile.mkdtemp())
+  import front_door_lambda, trigger_lambda, staging_pipeline
+
+  # Time each staging step on its own as well
+  staging_pipeline.STAGES[:] = [__timed(stage, name, timings, errors)
+    for stage, name in zip(list(staging_pipeline.STAGES), ['prepare', 'parse'])]
+
+  claims = {'custom:write': 'load_test'}
+  def run(msg):
+    event = {
+      'headers': {'authorization': 'offline'},
+      'requestContext': {'authorizer': {'jwt': {'claims': claims}}},
+      'body': json.dumps({'msg': base64.b64encode(msg.encode()).decode()})
+    }
+    response = __measure('front_door', lambda: front_door_lambda.lambda_handler(event, None), timings, errors)
+    if response is None: return
+    if response['statusCode'] != 201:
+      with lock: errors['front_door'] += 1
+      return
+
+    # What SNS would deliver to the trigger
+    sns_event = {'Records': [{'Sns': {'MessageId': str(random.getrandbits(64)), 'Message': msg, 'MessageAttributes': {}}}]}
+    __measure('trigger', lambda: trigger_lambda.lambda_handler(sns_event, None), timings, errors)
+
+  return run
+
+# Deployed: every worker thread keeps its own HTTP connection open between messages
+def __run_deployed(args, timings, errors):
+  import requests
+  from lib import cf_util, cognito_util
+
+  front_door_stack_name = args.stack_name + "-front-door"
+  url = cf_util.get_output_value(front_door_stack_name, "PostEr7RouteUrl")
+  app_client_id = cf_util.get_physical_resource_id(front_door_stack_name, "UserPoolClient")
+  id_token = cognito_util.get_id_token(args.user, args.password, app_client_id)
+  sessions = threading.local()
+
+  def run(msg):
+    if not hasattr(sessions, 'session'):
+      sessions.session = requests.Session()
+      sessions.session.headers.update({'Authorization': id_token, 'Content-Type': "application/json"})
+
+    data = json.dumps({'msg': base64.b64encode(msg.encode()).decode(), 'encoding': 'utf-8'})
+    response = __measure('front_door', lambda: sessions.session.post(url, data=data, verify=True), timings, errors)
+    if response is not None and response.status_code != 201:
+      with lock: errors['front_door'] += 1
+
+  return run
+
+def __measure(stage, function, timings, errors):
+  start = time.perf_counter()
+  try:
+    result = function()
+  except Exception:
+    result = None
+    with lock: errors[stage] += 1
+  ms = (time.perf_counter() - start) * 1000
+
+  with lock: timings[stage].append(ms)
+  return result
+
+def __timed(function, stage, timings, errors):
+  def timed(data, lambda_context):
+    start = time.perf_counter()
+    try:
+      return function(data, lambda_context)
+    except Exception:
+      with lock: errors[stage] += 1
+      raise
+    finally:
+      with lock: timings[stage].append((time.perf_counter() - start) * 1000)
+  return timed
+
+def __load_samples(pattern, mix):
+  samples = {}
+  for file_name in sorted(glob.glob(pattern)):
+    with open(file_name, encoding='utf-8') as f: samples[os.path.splitext(os.path.basename(file_name))[0]] = f.read()
+
+  weights = {name: 1.0 for name in samples}
+  if mix:
+    weights = {}
+    for entry in mix.split(','):
+      name, weight = entry.split('=')
+      if name not in samples: raise ValueError("No message file matches '{}'".format(name))
+      weights[name] = float(weight)
+
+  return [(samples[name], weight) for name, weight in weights.items()]
+
+def __get_variant(samples, position, synthetic_share):
+  er7 = random.choices([s for s, w in samples], weights=[w for s, w in samples])[0]
+  er7 = er7.replace('\r\n', '\r').replace('\n', '\r')
+  segments = er7.split('\r')
+  field_sep = segments[0][3]
+
+  for i, segment in enumerate(segments):
+    fields = segment.split(field_sep)
+    if fields[0] == 'MSH' and len(fields) > 9:
+      fields[9] = "LOAD{}{}".format(position, random.getrandbits(32)) # MSH-10 keeps every message unique
+    elif fields[0] == 'PID' and random.random() < synthetic_share:
+      component_sep = segments[0][4]
+      if len(fields) > 3: fields[3] = str(random.randint(100000, 999999))
+      if len(fields) > 5: fields[5] = component_sep.join(random.sample(SYNTHETIC_NAMES, 2))
+    segments[i] = field_sep.join(fields)
+
+  return '\r'.join(segments)
+
+def __summarize(timings, errors, elapsed):
+  ordered = sorted(timings)
+  return {
+    'count': len(ordered),
+    'errors': errors,
+    'error_rate': round(errors / len(ordered), 4),
+    'throughput_s': round(len(ordered) / elapsed, 2),
+    'p50_ms': round(__percentile(ordered, 50), 3),
+    'p95_ms': round(__percentile(ordered, 95), 3),
+    'p99_ms': round(__percentile(ordered, 99), 3),
+    'max_ms': round(ordered[-1], 3)
+  }
+
+# Nearest rank percentile of an ordered list
+def __percentile(ordered, percent):
+  rank = max(1, math.ceil(percent / 100.0 * len(ordered)))
+  return ordered[min(rank, len(ordered)) - 1]
+
+def __load_baseline(file_name):
+  if not file_name: return None
+  with open(file_name) as f: return json.load(f)
+
+def __print_results(results, baseline):
+  print("{} messages in {:.2f}s, {:.1f} msg/s".format(
+    results['config']['count'], results['elapsed_s'], results['throughput_msg_s']))
+  print("{:<12} {:>7} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+    "Stage", "Count", "Errors", "Per sec", "p50 (ms)", "p95 (ms)", "p99 (ms)", "vs base"))
+
+  for stage, summary in results['stages'].items():
+    change = ""
+    if baseline and stage in baseline.get('stages', {}):
+      # Change of the p95 latency, positive is slower
+      base_p95 = baseline['stages'][stage]['p95_ms']
+      if base_p95: change = "{:+.1f}%".format((summary['p95_ms'] - base_p95) * 100 / base_p95)
+
+    print("{:<12} {:>7} {:>8} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}".format(stage, summary['count'],
+      summary['errors'], summary['throughput_s'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], change))
+
+if __name__== "__main__":
+  main()
@@ -0,0 +1,166 @@
+import argparse, glob, json, logging, os, sys, tempfile, time, tracemalloc
+
+# Lets us import the Lambda modules the same way the Lambda runtime does
+sys.path.append(".")
+sys.path.append("microservices/staging_er7")
+import prepare_er7_lambda, parse_er7_lambda, er7_tokenizer, structure_index
+from hl7apy import parser
+
+# Times the prepare and parse steps over the sample corpus and over generated ORU messages that grow in one
+# dimension at a time: OBX segments, field repetitions and the size of an embedded FT/RTF payload.
+STAGES = ['prepare', 'hl7apy_parse', 'hl7apy_json', 'native']
+BASE_CASE = {'obx': 10, 'repetitions': 1, 'payload_kb': 0}
+MIN_REGRESSION_MS = 0.05
+
+def main():
+  parser_args = argparse.ArgumentParser()
+  parser_args.add_argument('-m', '--messages', help="Glob of ER7 message files", default="messages/*.txt")
+  parser_args.add_argument('--obx', help="OBX segment counts to generate", default="1,10,100,500")
+  parser_args.add_argument('--repetitions', help="PID-3 and OBX-5 repetition counts to generate", default="1,10,50")
+  parser_args.add_argument('--payload-kb', help="FT payload sizes (KB) to generate", default="0,16,64,256")
+  parser_args.add_argument('-n', '--iterations', help="Timed runs per stage, the best one is kept", type=int, default=5)
+  parser_args.add_argument('--no-hl7apy', help="Only time the native engine", action='store_true')
+  parser_args.add_argument('-o', '--output', help="Write the results as JSON to this file")
+  parser_args.add_argument('-b', '--baseline', help="Compare with the JSON results of a previous run")
+  parser_args.add_argument('--max-regression', help="Fail if a stage is this many percent slower than the baseline",
+    type=float)
+  args = parser_args.parse_args()
+
+  logging.disable(logging.CRITICAL) # The handlers log every message at INFO
+
+  # Load the index from files, as the Lambda does from the layer
+  structure_index.index_path = structure_index.write_index_files(tempfile.mkdtemp())
+
+  cases = []
+  for file_name in sorted(glob.glob(args.messages)):
+    with open(file_name, encoding='utf-8') as f: cases.append(('corpus', os.path.basename(file_name), f.read()))
+  for dimension, values in [('obx', args.obx), ('repetitions', args.repetitions), ('payload_kb', args.payload_kb)]:
+    for value in [int(v) for v in values.split(',')]:
+      settings = dict(BASE_CASE, **{dimension: value})
+      cases.append((dimension, "{}={}".format(dimension, value), generate_message(**settings)))
+
+  print("{:<26} {:>9} {:>9} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}".format("Case", "KB", "Segments",
+    "Prepare ms", "hl7apy ms", "to JSON ms", "Native ms", "hl7apy KB", "Native KB"))
+
+  results = {'iterations': args.iterations, 'cases': [__run_case(kind, name, er7, args) for kind, name, er7 in cases]}
+
+  regressions = __compare(results, __load_baseline(args.baseline), args.max_regression)
+  if args.output:
+    with open(args.output, 'w') as f: json.dump(results, f, indent=2)
+    print("Results written to '{}'".format(args.output))
+  if regressions: sys.exit(1)
+
+# Generated ORU^R01 message, the FT payload reads like the RTF 12-lead ECG report in lab01.txt
+def generate_message(obx=10, repetitions=1, payload_kb=0, control_id="GEN1"):
+  segments = [
+    "MSH|^~\\&|GENERATOR|LAB|BENCHMARK|LAB|20110621050440||ORU^R01|{}|P|2.3".format(control_id),
+    "PID|||{}||DOE^JOHN^Q||19600101|M".format("~".join("{}^^^HOSP^MR".format(100000 + i) for i in range(repetitions))),
+    "OBR|1||211088491|93000^ECG 12-LEAD^CPT4|||20110620170631|||||||||M999999^^^^^^^RACFID"
+  ]
+
+  for i in range(obx):
+    values = "~".join(str(50 + (i + r) % 400) for r in range(repetitions))
+    segments.append("OBX|{0}|NM|93000.{0}^MEASURE {0}^CPT4|{0}|{1}|MSEC|||||F".format(i + 1, values))
+
+  if payload_kb > 0:
+    line = "\\par LEAD II 17:06 RATE 52 PR 208 QRS 88 QT/QTC 466/433 AXIS P 45 QRS 12 T 38 "
+    body = line * (payload_kb * 1024 // len(line) + 1)
+    rtf = "{\\rtf1\\ansi \\deff1\\deflang1033 {\\fonttbl{\\f1\\fmodern\\fcharset0 Courier;}} \\pard\\plain " + \
+      body[:payload_kb * 1024] + "}"
+    segments.append("OBX|{0}|FT|93000^ECG 12-LEAD^CPT4|{0}|{1}||||||F".format(obx + 1, rtf))
+
+  return "\r".join(segments)
+
+def __run_case(kind, name, er7, args):
+  result = {'kind': kind, 'name': name, 'bytes': len(er7.encode()), 'stages': {}, 'memory': {}}
+  prepared = prepare_er7_lambda.lambda_handler(er7, None)
+  result['segments'] = len([s for s in prepared.split('\r') if s.strip()])
+
+  functions = {'prepare': lambda: prepare_er7_lambda.lambda_handler(er7, None)}
+  if not args.no_hl7apy:
+    functions['hl7apy_parse'] = lambda: parser.parse_message(prepared)
+  functions['native'] = lambda: er7_tokenizer.to_json(prepared)
+
+  for stage, function in list(functions.items()):
+    try:
+      result['stages'][stage] = __time(function, args.iterations)
+      if stage == 'hl7apy_parse':
+        # Converting an already parsed tree, as parse_er7_lambda does after parse_message
+        er7_obj = function()
+        index = structure_index.load_index(er7_obj.version) if parse_er7_lambda.use_structure_index else None
+        stage = 'hl7apy_json'
+        convert = lambda: parse_er7_lambda.__parse_er7_object_to_json(er7_obj, index)
+        result['stages']['hl7apy_json'] = __time(convert, args.iterations)
+        result['memory']['hl7apy'] = __measure_memory( # Parse and convert, as the Lambda does
+          lambda: parse_er7_lambda.__parse_er7_object_to_json(parser.parse_message(prepared), index))
+      elif stage == 'native':
+        result['memory']['native'] = __measure_memory(function)
+    except Exception as e:
+      result.setdefault('errors', {})[stage] = repr(e)
+
+  stages, memory = result['stages'], result['memory']
+  print("{:<26} {:>9.1f} {:>9} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}".format(name, result['bytes'] / 1024,
+    result['segments'], *[__format(stages.get(s), 'ms') for s in STAGES],
+    __format(memory.get('hl7apy'), 'peak_kb'), __format(memory.get('native'), 'peak_kb')))
+  for stage, error in result.get('errors', {}).items(): print("  {} failed: {}".format(stage, error))
+
+  return result
+
+def __time(function, iterations):
+  function() # Warm up
+  runs = []
+  for i in range(iterations):
+    start = time.perf_counter()
+    function()
+    runs.append((time.perf_counter() - start) * 1000)
+  return {'ms': round(min(runs), 4), 'mean_ms': round(sum(runs) / len(runs), 4)}
+
+# Peak memory while handling one message, and how many memory blocks the result keeps
+def __measure_memory(function):
+  tracemalloc.start()
+  try:
+    before_blocks = sys.getallocatedblocks()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function()
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks() - before_blocks
+  finally:
+    tracemalloc.stop()
+
+  del result
+  return {'peak_kb': round((peak - before) / 1024, 1), 'retained_kb': round((current - before) / 1024, 1),
+    'retained_blocks': blocks}
+
+def __format(values, key):
+  return "-" if values is None else "{:.3f}".format(values[key]) if key == 'ms' else "{:.1f}".format(values[key])
+
+def __load_baseline(file_name):
+  if not file_name: return None
+  with open(file_name) as f: return json.load(f)
+
+# Compares the best time of every stage of every case with the baseline, returns the regressions found
+def __compare(results, baseline, max_regression):
+  if baseline is None: return []
+  base_cases = {(c['kind'], c['name']): c for c in baseline['cases']}
+
+  regressions = []
+  print("\n{:<26} {:<14} {:>12} {:>12} {:>9}".format("Case", "Stage", "Base ms", "Now ms", "Change"))
+  for case in results['cases']:
+    base_case = base_cases.get((case['kind'], case['name']))
+    if base_case is None: continue
+
+    for stage, values in case['stages'].items():
+      if stage not in base_case['stages'] or not base_case['stages'][stage]['ms']: continue
+      base_ms = base_case['stages'][stage]['ms']
+      change = (values['ms'] - base_ms) * 100 / base_ms
+      flag = ""
+      # Stages that take a few microseconds are too noisy to call a regression
+      if max_regression is not None and change > max_regression and values['ms'] - base_ms > MIN_REGRESSION_MS:
+        regressions.append((case['name'], stage, change))
+        flag = " REGRESSION"
+      print("{:<26} {:<14} {:>12.3f} {:>12.3f} {:>+8.1f}%{}".format(case['name'], stage, base_ms, values['ms'], change, flag))
+
+  return regressions
+
+if __name__== "__main__":
+  main()
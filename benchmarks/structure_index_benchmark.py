@@ -0,0 +1,52 @@
+import argparse, glob, logging, os, sys, tempfile, time
+
+# Lets us import the Lambda modules the same way the Lambda runtime does
+sys.path.append(".")
+sys.path.append("microservices/staging_er7")
+import prepare_er7_lambda, parse_er7_lambda, er7_tokenizer, er7_view, structure_index
+from hl7apy import parser
+
+def main():
+  parser_args = argparse.ArgumentParser()
+  parser_args.add_argument('-m', '--messages', help="Glob of ER7 message files", default="messages/*.txt")
+  parser_args.add_argument('-n', '--iterations', help="Iterations per message", type=int, default=20)
+  args = parser_args.parse_args()
+
+  logging.disable(logging.CRITICAL) # The handlers log every message at INFO
+  
+  # Load the index from files, as the Lambda does from the layer
+  index_folder = structure_index.write_index_files(tempfile.mkdtemp())
+  structure_index.index_path = index_folder
+
+  print("{:<26} {:<12} {:>12} {:>12} {:>8} {:>12} {:>8}".format(
+    "File", "Type", "Tree (ms)", "Index (ms)", "Speedup", "Native (ms)", "Speedup"))
+
+  for file_name in sorted(glob.glob(args.messages)):
+    with open(file_name, encoding='utf-8') as f: er7 = prepare_er7_lambda.lambda_handler(f.read(), None)
+    encoding_chars = er7_view.get_encoding_chars(er7.lstrip())
+    message_structure, version = er7_tokenizer.get_message_info(er7.lstrip(), encoding_chars)
+    message_type = "{} {}".format(message_structure, version)
+
+    try:
+      er7_obj = parser.parse_message(er7)
+      index = structure_index.load_index(er7_obj.version)
+
+      # Converting the same hl7apy tree with and without the index, then the native engine end to end
+      tree_ms = __time(lambda: parse_er7_lambda.__parse_er7_object_to_json(er7_obj), args.iterations)
+      index_ms = __time(lambda: parse_er7_lambda.__parse_er7_object_to_json(er7_obj, index), args.iterations)
+      native_ms = __time(lambda: er7_tokenizer.to_json(er7), args.iterations)
+    except Exception as e:
+      print("{:<26} {:<12} could not be converted: {}".format(os.path.basename(file_name), message_type, repr(e)))
+      continue
+
+    print("{:<26} {:<12} {:>12.3f} {:>12.3f} {:>7.1f}x {:>12.3f} {:>7.1f}x".format(
+      os.path.basename(file_name), message_type, tree_ms, index_ms, tree_ms/index_ms, native_ms, tree_ms/native_ms))
+
+def __time(function, iterations):
+  function() # Warm up
+  start = time.perf_counter()
+  for i in range(iterations): function()
+  return (time.perf_counter() - start) * 1000 / iterations
+
+if __name__== "__main__":
+  main()
@@ -0,0 +1,45 @@
+import argparse, sys
+
+# Lets us find our lib folder for import
+sys.path.append(".")
+from lib import cf_util, compaction_util
+
+def main():
+  # Get the arguments
+  parser = argparse.ArgumentParser()
+  group = parser.add_mutually_exclusive_group(required=True)
+  group.add_argument('-s', '--stack-name', help="Stack name, compacts its data lake bucket")
+  group.add_argument('-b', '--bucket', help="Bucket to compact")
+  parser.add_argument('--source', help="Only compact this source", action='append')
+  parser.add_argument('-f', '--format', help="Layout of the part files", choices=list(compaction_util.FORMATS),
+    default='ndjson')
+  parser.add_argument('--part-size-mb', help="Approximate size of each part file", type=int, default=128)
+  parser.add_argument('--min-age-minutes', help="Leave messages younger than this in place", type=int, default=60)
+  parser.add_argument('-w', '--workers', help="Objects fetched concurrently", type=int, default=16)
+  parser.add_argument('--delete-source', help="Delete the original objects once their part is committed",
+    action='store_true')
+  parser.add_argument('--fetch', help="Print one compacted message by its id (hash) instead of compacting")
+
+  args = parser.parse_args()
+  bucket = args.bucket or cf_util.get_physical_resource_id(args.stack_name + "-core", "Bucket")
+  sources = args.source or compaction_util.list_sources(bucket)
+
+  if args.fetch:
+    for source in sources:
+      entry = compaction_util.find_message(bucket, source, args.fetch)
+      if entry:
+        print(compaction_util.get_message(bucket, entry))
+        return
+    print("Message '{}' not found in the compacted zone".format(args.fetch))
+    sys.exit(1)
+
+  # Safe to re-run at any time, each run picks up where the last committed part left off
+  total = 0
+  for source in sources:
+    parts = compaction_util.compact_source(bucket, source, args.format, args.part_size_mb*1024*1024,
+      args.min_age_minutes*60, args.workers, args.delete_source)
+    total += sum(part['count'] for part in parts)
+  print("Compacted {} message(s) from {} source(s)".format(total, len(sources)))
+
+if __name__== "__main__":
+  main()
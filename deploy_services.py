@@ -1,7 +1,7 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
 from botocore.exceptions import ClientError
-import argparse, sys, os
+import argparse, sys, os, time
 from lib import cf_util
 
 # Lets us find our lib folder for import
@@ -11,12 +11,25 @@ from microservices.front_door import front_door_setup
 from microservices.staging_er7 import staging_setup
 
 cf = boto3.client('cloudformation')
+SKIPPED = "SKIPPED" # Not run because a task it depends on failed
+NOT_FOUND = "NOT_FOUND"
 
 def main():
   # Get the arguments
   parser = argparse.ArgumentParser()
   parser.add_argument('-s', '--stack-name', help="Stack name", required=True)
   parser.add_argument('-d', help="Delete stack", action='store_true')
+  parser.add_argument('-p', '--parse-engine', help="ER7 parse engine", choices=['hl7apy', 'native'], default='hl7apy')
+  parser.add_argument('-m', '--staging-mode', help="Run staging through the Step Function or in-process",
+    choices=['step_function', 'in_process'], default='step_function')
+  parser.add_argument('--parquet-layer-arn', help="Layer with pyarrow, deploys the Parquet staged zone when given",
+    default='')
+  parser.add_argument('--parse-fields', help="Comma separated paths (e.g. MSH.9.1,PID.3.1) the parse step outputs "
+    "in place of the full JSON", default='')
+  parser.add_argument('--hl7-versions', help="Comma separated HL7 versions (e.g. 2.3,2.5.1) kept in the parsing "
+    "library layer, all of them when not given", default='')
+  parser.add_argument('--structure-index', help="Look up element structures in the precompiled index instead of "
+    "the hl7apy tree", action='store_true')
 
   args = parser.parse_args()
   stack_name = args.stack_name
@@ -25,32 +38,108 @@ def main():
   core_stack_name = stack_name +"-core"
   front_door_stack_name = stack_name +"-front-door"
   staging_stack_name = stack_name +"-staging"
+
+  # Stack -> the stacks it imports from, each stack starts as soon as those are done
+  dependencies = {
+    core_stack_name: [],
+    front_door_stack_name: [core_stack_name],
+    staging_stack_name: [core_stack_name]
+  }
   
   if (args.d):
-    # Delete all but core in parallel first
-    print ("Delete all but core first...")
-    cf_util.delete_stacks(front_door_stack_name, staging_stack_name)
-    
-    # Delete core
-    print("Delete core...")
-    
-    # Delete all objects from our buckets
-    s3 = boto3.resource('s3')
-    try:
-      s3.Bucket(cf_util.get_physical_resource_id(core_stack_name, "Bucket")).object_versions.delete()
-      s3.Bucket(cf_util.get_physical_resource_id(core_stack_name, "ArtifactBucket")).object_versions.delete()
-    except ClientError as e:
-      if "does not exist" in e.response['Error']['Message']: None # Stack already isn't there
-      else: raise
-    
-    cf_util.delete_stacks(core_stack_name)
+    # Delete in reverse, a stack goes once every stack that imports from it is gone
+    print ("Deleting the stacks...")
+    tasks = {
+      front_door_stack_name: lambda: __delete_stack(front_door_stack_name),
+      staging_stack_name: lambda: __delete_stack(staging_stack_name),
+      core_stack_name: lambda: __delete_core_stack(core_stack_name)
+    }
+    results = __run(tasks, __reverse(dependencies))
   else: 
-    print ("Deploying the core stack...")
-    core_setup.deploy(core_stack_name, True)
-    
-    print ("Deploying the remaining stacks...")
-    front_door_setup.deploy(front_door_stack_name, core_stack_name, False)
-    staging_setup.deploy(staging_stack_name, core_stack_name, False)
+    print ("Deploying the stacks...")
+    tasks = {
+      core_stack_name: lambda: core_setup.deploy(core_stack_name, True),
+      front_door_stack_name: lambda: front_door_setup.deploy(front_door_stack_name, core_stack_name, True),
+      staging_stack_name: lambda: staging_setup.deploy(staging_stack_name, core_stack_name, True, args.parse_engine,
+        args.staging_mode, args.parquet_layer_arn, args.parse_fields, args.hl7_versions, args.structure_index)
+    }
+    results = __run(tasks, dependencies)
+
+  __print_timings(results)
+  if any(__failed(outcome) for outcome, seconds in results.values()): sys.exit(1)
+
+# Runs every task once the tasks it depends on have succeeded, independent tasks at the same time
+def __run(tasks, dependencies):
+  results = {} # Name -> (outcome, seconds), the outcome is the exception when the task failed
+  running = {} # Future -> (name, start time)
+
+  with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+    while len(results) < len(tasks):
+      started = [name for name, start in running.values()]
+      for name, task in tasks.items():
+        if name in results or name in started: continue
+        needed = [results.get(n) for n in dependencies[name]]
+        if any(r is not None and __failed(r[0]) for r in needed):
+          results[name] = (SKIPPED, 0)
+        elif all(r is not None for r in needed):
+          print("Starting '{}'...".format(name))
+          running[executor.submit(task)] = (name, time.time())
+      if not running: continue # Only skipped tasks this round, look again at the ones after them
+
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        name, start = running.pop(future)
+        try:
+          outcome = future.result()
+        except Exception as e:
+          outcome = e
+        results[name] = (outcome, time.time() - start)
+        print("Finished '{}' in {:.1f}s: {}".format(name, results[name][1], outcome))
+
+  return results
+
+def __failed(outcome):
+  return outcome == SKIPPED or isinstance(outcome, Exception)
+
+def __reverse(dependencies):
+  dependents = {name: [] for name in dependencies}
+  for name, needed in dependencies.items():
+    for n in needed: dependents[n].append(name)
+  return dependents
+
+def __delete_stack(stack_name):
+  if not cf_util.stack_exists(stack_name): return NOT_FOUND
+  return __check_deleted(stack_name, cf_util.delete_stacks(stack_name)[0])
+
+# A stack that could not be deleted fails its task, so the stacks it imports from are kept
+def __check_deleted(stack_name, status):
+  if status != 'DELETE_COMPLETE':
+    raise RuntimeError("Deletion of stack '{}' ended with status {}".format(stack_name, status))
+  return status
+
+def __delete_core_stack(stack_name):
+  if not cf_util.stack_exists(stack_name): return NOT_FOUND
+
+  # Buckets must be empty before the stack can delete them
+  buckets = [cf_util.get_physical_resource_id(stack_name, "Bucket"),
+    cf_util.get_physical_resource_id(stack_name, "ArtifactBucket")]
+  with ThreadPoolExecutor() as executor: list(executor.map(__empty_bucket, buckets))
+
+  return __check_deleted(stack_name, cf_util.delete_stacks(stack_name)[0])
+
+def __empty_bucket(bucket_name):
+  try:
+    # A session per thread, resources cannot be shared between threads
+    boto3.session.Session().resource('s3').Bucket(bucket_name).object_versions.delete()
+  except ClientError as e:
+    if "does not exist" in e.response['Error']['Message']: None # Bucket already isn't there
+    else: raise
+
+def __print_timings(results):
+  print("{:<40} {:<24} {:>10}".format("Stack", "Outcome", "Time (s)"))
+  for name, (outcome, seconds) in results.items():
+    print("{:<40} {:<24} {:>10.1f}".format(name, type(outcome).__name__ if isinstance(outcome, Exception) else
+      str(outcome), seconds))
     
 if __name__== "__main__":
   main()
\ No newline at end of file
@@ -1,26 +1,31 @@
 import boto3
 from botocore.exceptions import ClientError
-import time
+import hashlib, json, os, tempfile, time
 
 cf = boto3.client('cloudformation')
 USE_PREVIOUS_VALUE = "4978#@#$@!)*&@#/$3423" # Random string to avoid collision; not a complex enough case to warrant Enums
 NO_UPDATES = "NO_UPDATES"
-cache_map = {} # Used to cache results
+stack_cache = {} # Stack name -> {'stack': description or None when it does not exist, 'resources': logical -> physical id}
+VALIDATED_TEMPLATES_FILE = os.path.join(tempfile.gettempdir(), "hcdl_validated_templates.json") # Hashes of valid templates
+MIN_WAIT = 2 # Seconds between checks for stack events, right after new events were seen
+MAX_WAIT = 15 # Longest wait between checks when nothing is happening
+WAIT_BACKOFF = 1.5
 
 def create_or_update_stack(stack_name, template_file_path, params, capabilities=[], wait=True):
   template_data = __parse_template(template_file_path)
   parameter_map = __get_parameter_map(params)
-  
+
   try:
     if stack_exists(stack_name):
+      last_event_id = __get_last_event_id(stack_name) # Events up to here belong to earlier deployments
       response = cf.update_stack(
         StackName=stack_name,
         TemplateBody=template_data,
         Parameters=parameter_map,
         Capabilities=capabilities
       )
-      waiter = cf.get_waiter('stack_update_complete')
     else:
+      last_event_id = None
       response = cf.create_stack(
         StackName=stack_name,
         TemplateBody=template_data,
@@ -28,83 +33,143 @@ def create_or_update_stack(stack_name, template_file_path, params, capabilities=
         Capabilities=capabilities,
         OnFailure='DELETE'
       )
-      waiter = cf.get_waiter('stack_create_complete')
-    
-    if wait:  
-      # Wait until stack deployment has finished
-      waiter.wait(StackName=stack_name)
   except ClientError as ex:
     error_message = ex.response['Error']['Message']
     if error_message == 'No updates are to be performed.': return NO_UPDATES
     else: raise
-  
+  finally:
+    invalidate(stack_name)
+
+  if wait:
+    # Wait until stack deployment has finished
+    status = wait_for_stack(response['StackId'], last_event_id)
+    if status not in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
+      raise RuntimeError("Deployment of stack '{}' ended with status {}".format(stack_name, status))
+    return status
+
   return cf.describe_stacks(StackName=stack_name)['Stacks'][0]['StackStatus']
 
 # Delete batches of stacks in parallel
 def delete_stacks(*stack_names):
-  stack_ids = []
-  
+  stacks = []
+
   # Kick off the deletes
   for stack_name in stack_names:
-    stack_id = cf.describe_stacks(StackName=stack_name)['Stacks'][0]['StackId']
-    stack_ids.append(stack_id)
+    stack_id = __describe(stack_name)['StackId']
+    stacks.append((stack_id, __get_last_event_id(stack_id)))
     cf.delete_stack(StackName=stack_name)
-  
-  # Wait until they all complete
+    invalidate(stack_name)
+
+  # Wait until they all complete, they are deleted at the same time so waiting in turn takes no longer
+  return [wait_for_stack(stack_id, last_event_id) for stack_id, last_event_id in stacks] # In the order given
+
+# Follows the events of the stack until it settles and returns its final status. Checks are frequent while
+# events come in and back off while nothing happens. Failures are printed as they happen.
+def wait_for_stack(stack_id, last_event_id=None):
+  delay = MIN_WAIT
   while True:
-    complete = True
-    for stack_id in stack_ids:
-      status = cf.describe_stacks(StackName=stack_id)['Stacks'][0]['StackStatus']
-      if status not in ['DELETE_COMPLETE', 'DELETE_FAILED']:
-        complete = False
-        break
-    
-    if complete: break
-    else: time.sleep(5)
+    events = __get_new_events(stack_id, last_event_id)
+    if events:
+      last_event_id = events[-1]['EventId']
+      delay = MIN_WAIT
+
+    for event in events:
+      if event['ResourceStatus'].endswith('_FAILED'):
+        print("{}: {} {} {}".format(event['StackName'], event['LogicalResourceId'], event['ResourceStatus'],
+          event.get('ResourceStatusReason', '')))
+      if event['PhysicalResourceId'] == stack_id and not event['ResourceStatus'].endswith('_IN_PROGRESS'):
+        invalidate(event['StackName'])
+        return event['ResourceStatus']
+
+    time.sleep(delay)
+    delay = min(delay * WAIT_BACKOFF, MAX_WAIT)
 
 def stack_exists(stack_name):
-  stacks = cf.list_stacks()['StackSummaries']
-  for stack in stacks:
-    if stack['StackStatus'] == 'DELETE_COMPLETE':
-      continue
-    if stack_name == stack['StackName']:
-      return True
-  return False
-  
+  return __describe(stack_name) is not None
+
 def get_physical_resource_id(stack_name, logical_resource_id):
-  key = stack_name +":" +logical_resource_id
-  
-  if not key in cache_map:
-    physical_resource_id = cf.describe_stack_resource(
-      StackName=stack_name, LogicalResourceId=logical_resource_id
-      )['StackResourceDetail']['PhysicalResourceId']
-    cache_map[key] = physical_resource_id
-      
-  return cache_map[key]
+  entry = __get_cache_entry(stack_name)
+
+  # All resources of the stack are listed at once, the first time one of them is needed
+  if entry.get('resources') is None:
+    resources = {}
+    for page in cf.get_paginator('list_stack_resources').paginate(StackName=stack_name):
+      for resource in page['StackResourceSummaries']:
+        resources[resource['LogicalResourceId']] = resource.get('PhysicalResourceId')
+    entry['resources'] = resources
+
+  if logical_resource_id not in entry['resources']:
+    raise KeyError("Resource '{}' not found in stack '{}'".format(logical_resource_id, stack_name))
+  return entry['resources'][logical_resource_id]
 
 def get_output_value(stack_name, output_name):
-  response = cf.describe_stacks(StackName=stack_name)
-  outputs = response["Stacks"][0]["Outputs"]
+  stack = __describe(stack_name)
+  outputs = stack.get("Outputs", []) if stack else []
   for output in outputs:
     keyName = output["OutputKey"]
     if keyName == output_name:
       return output["OutputValue"]
-  
+
   return None
-  
+
+# Forgets what is known about the stack, after it changes
+def invalidate(stack_name):
+  stack_cache.pop(stack_name, None)
+
+def __get_cache_entry(stack_name):
+  return stack_cache.setdefault(stack_name, {})
+
+def __describe(stack_name):
+  entry = __get_cache_entry(stack_name)
+  if 'stack' not in entry:
+    try:
+      entry['stack'] = cf.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except ClientError as e:
+      if "does not exist" in e.response['Error']['Message']: entry['stack'] = None
+      else: raise
+  return entry['stack']
+
+def __get_last_event_id(stack_name):
+  events = cf.describe_stack_events(StackName=stack_name)['StackEvents'] # Newest first
+  return events[0]['EventId'] if events else None
+
+# Events after the given one, oldest first
+def __get_new_events(stack_id, last_event_id):
+  events = []
+  for page in cf.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+    for event in page['StackEvents']:
+      if event['EventId'] == last_event_id: return events[::-1]
+      events.append(event)
+  return events[::-1]
+
+# Templates are only validated again when their content changes
 def __parse_template(template):
   with open(template) as template_fileobj: template_data = template_fileobj.read()
+  template_hash = hashlib.sha256(template_data.encode()).hexdigest()
+  validated = __load_validated_templates()
+  if validated.get(os.path.abspath(template)) == template_hash: return template_data
+
   response = cf.validate_template(TemplateBody=template_data)
   # if "CapabilitiesReason" in response:
   #   raise ValueError("Template '{}' failed validation: '{}'".format(template, response['CapabilitiesReason']))
 
+  validated = __load_validated_templates() # Other stacks may have been validated in the meantime
+  validated[os.path.abspath(template)] = template_hash
+  with open(VALIDATED_TEMPLATES_FILE, 'w') as f: json.dump(validated, f)
+
   return template_data
 
+def __load_validated_templates():
+  try:
+    with open(VALIDATED_TEMPLATES_FILE) as f: return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
 def __get_parameter_map(params):
   parameter_map=[]
-  for key, value in params.items(): 
+  for key, value in params.items():
     if value == USE_PREVIOUS_VALUE:
       parameter_map.append({'ParameterKey': key,'UsePreviousValue': True})
     else:
       parameter_map.append({'ParameterKey': key,'ParameterValue': value})
-  return parameter_map
\ No newline at end of file
+  return parameter_map
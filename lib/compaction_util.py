@@ -0,0 +1,139 @@
+import json, os, struct, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+s3 = boto3.client('s3')
+
+# Consolidates the one-object-per-message ingest zone of each source into large part files:
+#   source=<s>/protocol=hl7v2/format=er7/zone=ingest/<hash>.txt   (input)
+#   source=<s>/protocol=hl7v2/format=er7/zone=compacted/part-<n>.<ext>   (output)
+# Each part has a sidecar index (part-<n>.index.ndjson) with the offset and length of every message so a single
+# message can still be fetched with a ranged GET. A checkpoint lists the committed parts: messages found in their
+# indexes are never compacted again, and parts written after the last checkpoint are simply rewritten on re-run.
+INGEST_ZONE = "protocol=hl7v2/format=er7/zone=ingest/"
+COMPACTED_ZONE = "protocol=hl7v2/format=er7/zone=compacted/"
+CHECKPOINT_NAME = "_checkpoint.json"
+FORMATS = {'ndjson': 'ndjson', 'length-prefixed': 'bin'} # Format -> part file extension
+LENGTH_PREFIX = struct.Struct('>I') # 4 byte big-endian length before each message
+
+def list_sources(bucket):
+  sources = []
+  for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix='source=', Delimiter='/'):
+    sources += [p['Prefix'][len('source='):-1] for p in page.get('CommonPrefixes', [])]
+  return sources
+
+def compact_source(bucket, source, format='ndjson', part_size=128*1024*1024, min_age=3600, workers=16,
+    delete_source=False):
+  ingest_prefix = "source={}/{}".format(source, INGEST_ZONE)
+  compacted_prefix = "source={}/{}".format(source, COMPACTED_ZONE)
+  checkpoint = __get_checkpoint(bucket, compacted_prefix)
+  compacted = __get_compacted_keys(bucket, compacted_prefix, checkpoint)
+
+  # Only messages old enough to be done with, listed in key order so a re-run builds the same parts
+  cutoff = time.time() - min_age
+  pending, done = [], []
+  for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=ingest_prefix):
+    for obj in page.get('Contents', []):
+      if obj['Key'] in compacted: done.append(obj['Key'])
+      elif obj['LastModified'].timestamp() <= cutoff: pending.append(obj)
+
+  # Messages compacted by an earlier run that stopped before removing them
+  if delete_source and done: __delete_keys(bucket, done)
+
+  parts = []
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for batch in __get_part_batches(pending, part_size):
+      part_name = "part-{:06d}".format(checkpoint['next_part'])
+      part = __write_part(bucket, compacted_prefix, part_name, batch, format, executor)
+
+      # Commit the part, only then is it safe to remove the messages it holds
+      checkpoint['parts'].append(part)
+      checkpoint['next_part'] += 1
+      __put_json(bucket, compacted_prefix + CHECKPOINT_NAME, checkpoint)
+      parts.append(part)
+      print("Compacted {} message(s) of source '{}' into '{}'".format(part['count'], source, part['key']))
+
+      if delete_source: __delete_keys(bucket, [obj['Key'] for obj in batch])
+
+  return parts
+
+# Fetches one message from a compacted part using an entry of its index
+def get_message(bucket, entry):
+  end = entry['offset'] + entry['length'] - 1
+  data = s3.get_object(Bucket=bucket, Key=entry['part'], Range="bytes={}-{}".format(entry['offset'], end))['Body'].read()
+  if entry['part'].endswith('.ndjson'): return json.loads(data)['msg']
+  return data.decode('utf-8')
+
+def find_message(bucket, source, msg_hash):
+  compacted_prefix = "source={}/{}".format(source, COMPACTED_ZONE)
+  for part in __get_checkpoint(bucket, compacted_prefix)['parts']:
+    for entry in __read_index(bucket, part['index']):
+      if entry['id'] == msg_hash: return entry
+  return None
+
+def __write_part(bucket, compacted_prefix, part_name, batch, format, executor):
+  part_key = "{}{}.{}".format(compacted_prefix, part_name, FORMATS[format])
+  index_key = "{}{}.index.ndjson".format(compacted_prefix, part_name)
+
+  # Stream the messages through a temporary file, fetching them concurrently but writing them in key order
+  index = []
+  offset = 0
+  with tempfile.TemporaryFile() as f:
+    for obj, body in __iter_bodies(bucket, batch, executor):
+      msg_id = os.path.splitext(os.path.basename(obj['Key']))[0]
+      if format == 'ndjson':
+        record = json.dumps({'id': msg_id, 'msg': body.decode('utf-8')}).encode('utf-8') + b"\n"
+        entry = {'offset': offset, 'length': len(record) - 1} # Without the newline
+      else:
+        record = LENGTH_PREFIX.pack(len(body)) + body
+        entry = {'offset': offset + LENGTH_PREFIX.size, 'length': len(body)} # Just the message
+      f.write(record)
+      index.append(dict(entry, id=msg_id, key=obj['Key'], part=part_key))
+      offset += len(record)
+
+    f.seek(0)
+    s3.upload_fileobj(f, bucket, part_key) # Multipart for large parts
+
+  s3.put_object(Bucket=bucket, Key=index_key, Body="".join(json.dumps(e) + "\n" for e in index).encode('utf-8'),
+    ContentType="application/x-ndjson")
+  return {'key': part_key, 'index': index_key, 'count': len(index), 'bytes': offset}
+
+# Yields (object, body) in order with a bounded number of bodies fetched ahead
+def __iter_bodies(bucket, objects, executor, window=256):
+  for start in range(0, len(objects), window):
+    chunk = objects[start:start+window]
+    yield from zip(chunk, executor.map(lambda obj: s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read(), chunk))
+
+# Groups the objects into parts of about part_size bytes
+def __get_part_batches(objects, part_size):
+  batch, size = [], 0
+  for obj in objects:
+    if batch and size + obj['Size'] > part_size:
+      yield batch
+      batch, size = [], 0
+    batch.append(obj)
+    size += obj['Size']
+  if batch: yield batch
+
+def __get_checkpoint(bucket, compacted_prefix):
+  try:
+    return json.loads(s3.get_object(Bucket=bucket, Key=compacted_prefix + CHECKPOINT_NAME)['Body'].read())
+  except s3.exceptions.NoSuchKey:
+    return {'parts': [], 'next_part': 0}
+
+def __get_compacted_keys(bucket, compacted_prefix, checkpoint):
+  keys = set()
+  for part in checkpoint['parts']:
+    keys.update(entry['key'] for entry in __read_index(bucket, part['index']))
+  return keys
+
+def __read_index(bucket, index_key):
+  body = s3.get_object(Bucket=bucket, Key=index_key)['Body'].read().decode('utf-8')
+  return [json.loads(line) for line in body.splitlines() if line]
+
+def __put_json(bucket, key, data):
+  s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(data).encode('utf-8'), ContentType="application/json")
+
+def __delete_keys(bucket, keys):
+  for start in range(0, len(keys), 1000): # Most keys S3 deletes in one call
+    s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys[start:start+1000]], 'Quiet': True})
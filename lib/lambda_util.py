@@ -1,107 +1,204 @@
-import tempfile, urllib, tarfile, shutil, os, zipfile
+import tempfile, urllib.request, tarfile, shutil, os, sys, zipfile, io, hashlib, json, subprocess
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
 
 s3 = boto3.client('s3')
+HASH_METADATA = 'sha256' # Object metadata holding the hash of the zip content
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0) # Fixed so the same files always give the same zip
+ZIP_FILE_MODE = 0o644 << 16
+# Downloads and built layers, kept between deployments
+cache_folder = os.environ.get('HCDL_CACHE_FOLDER', os.path.join(os.path.expanduser('~'), '.cache', 'hcls-data-lake'))
 
-def sync_lambda_function(function_file, bucket_name):
+def sync_lambda_function(function_file, bucket_name, module_files=[]):
   # Get the file name without the path
   function_name = os.path.basename(function_file)
   
   # The zip file will have the same name, but with a .zip extension
   if function_file.endswith('.py'): object_key = function_name.replace(".py",".zip")
   
-  # Get the last modified date of the file (seconds since the Epoch)
-  file_mtime = os.path.getmtime(function_file)
+  # Zip the function and the modules it imports in memory, the same content always gives the same hash
+  data = __get_zip([(f, os.path.basename(f)) for f in [function_file] + module_files])
+  content_hash = hashlib.sha256(data).hexdigest()
 
-  # Check attributes of object on S3
+  # If the object on S3 has the same content, simply return the existing key and version
   try:
     header = s3.head_object(Bucket=bucket_name, Key=object_key)
-    object_mtime = header['LastModified'].timestamp()
-  
-    # If the local file is older than the one on S3, simply return the existing key and version
-    if file_mtime <= object_mtime:
+    if header.get('Metadata', {}).get(HASH_METADATA) == content_hash:
       return object_key, header['VersionId']
   except ClientError as e:
     if e.response['Error']['Code'] == "404": None # If the file isn't found then proceed with the upload
     else:
       raise
   
-  # Create a zip file from the function
-  zipfile.ZipFile(object_key, mode='w').write(function_file, arcname=function_name)
-  
-  try:
-    __upload_file(object_key, bucket_name)
-    return object_key, s3.head_object(Bucket=bucket_name, Key=object_key)['VersionId']
-  except ClientError as e: raise
-  finally:
-    os.remove(object_key) # Delete the temporary zip file
+  response = s3.put_object(Bucket=bucket_name, Key=object_key, Body=data, Metadata={HASH_METADATA: content_hash})
+  print("Uploaded '{}'".format(object_key))
+  return object_key, response['VersionId']
 
-def upload_external_library_for_lambda_layer(url, bucket, language):
-  # Determine the key
-  file_name = url[url.rindex('/')+1:]
-  
-  # Key will replace existing extension with zip
-  zip_key = file_name.replace(".tar.gz","") + ".zip"
+# Syncs several functions at the same time, each given as (function file, module files). Returns their
+# (key, version) in the same order.
+def sync_lambda_functions(functions, bucket_name, max_workers=8):
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(sync_lambda_function, function_file, bucket_name, module_files)
+      for function_file, module_files in functions]
+    return [future.result() for future in futures]
 
-  # If this key is already in our bucket then just return the key and version
+# Builds a Lambda Layer holding the given packages of a Python source distribution and uploads it, unless the
+# bucket already has the same build. Downloads and built layers are kept in a local cache addressed by content,
+# so builds that were done before work offline. The bytecode is precompiled for the runtime of the functions so
+# they do not compile it at each cold start. import_check is a statement (e.g. 'import hl7apy') timed on the
+# built layer.
+def upload_python_layer(url, bucket, packages, runtime='python3.9', prepare_function=None, build_id='',
+    import_check=None):
+  download_path, download_hash = get_download(url)
+
+  # The key depends on everything that goes into the build
+  build_hash = hashlib.sha256(json.dumps([download_hash, sorted(packages), runtime, build_id]).encode()).hexdigest()
+  zip_key = "{}-{}.zip".format(os.path.basename(url).replace(".tar.gz",""), build_hash[:12])
+
+  # If this key is already in our bucket then just return it
   try: 
-    header = s3.head_object(Bucket=bucket, Key=zip_key)
-    print("Library '{}' already exists, skipping download and sync".format(zip_key))
+    s3.head_object(Bucket=bucket, Key=zip_key)
+    print("Layer '{}' already exists, skipping build and sync".format(zip_key))
     return zip_key
   except ClientError as e:
     if e.response['Error']['Code'] == "404": None # If the file isn't found then proceed with the upload
     else: raise
-  
-  # Determine working directory
-  wd = os.getcwd()
-  
-  # Create temporary directory and move to it
-  td = tempfile.mkdtemp()
-  os.chdir(td)
-  
-  # Download the file
-  print ("Downloading file '{}' as '{}'".format(url, file_name))
-  urllib.request.urlretrieve(url, file_name)
-  
-  # ----------- Process to make Lambda Layer friendly
-  # Untar 
-  tar = tarfile.open(file_name)
-  tar.extractall()
-  tar.close()  
-  
-  # Rename top folder to work as Lambda Layer
-  lib_folder = file_name.replace(".tar.gz","")
 
-  if language == 'python':
-    os.rename(lib_folder, language) # Top folder for Lambda Layer expects 'python'
-  
-  # ----------- Zip and upload
-  __zip_folder(zip_key, language)
-  __upload_file(zip_key, bucket)
+  zip_path = os.path.join(cache_folder, 'layers', zip_key)
+  if os.path.exists(zip_path): print("Using layer '{}' built before".format(zip_key))
+  else: __build_python_layer(download_path, zip_path, packages, runtime, prepare_function, import_check)
 
-  # Go back to initial working directory
-  os.chdir(wd)
-  
-  # Delete the temporary directory and contents
-  shutil.rmtree(td)
-  
+  __upload_file(zip_path, bucket)
   return zip_key
 
+# Path and sha256 of the downloaded file, only downloaded the first time the url is asked for
+def get_download(url):
+  urls = __load_json(os.path.join(cache_folder, 'urls.json'))
+  if url in urls and os.path.exists(__get_download_path(urls[url])):
+    return __get_download_path(urls[url]), urls[url]
+
+  print("Downloading '{}'".format(url))
+  os.makedirs(os.path.join(cache_folder, 'downloads'), exist_ok=True)
+  digest = hashlib.sha256()
+  with tempfile.NamedTemporaryFile(dir=os.path.join(cache_folder, 'downloads'), delete=False) as f:
+    with urllib.request.urlopen(url) as response:
+      for chunk in iter(lambda: response.read(1024*1024), b''):
+        digest.update(chunk)
+        f.write(chunk)
+  download_hash = digest.hexdigest()
+  os.replace(f.name, __get_download_path(download_hash))
+
+  # Read again right before writing as other builds may have added their own
+  urls = __load_json(os.path.join(cache_folder, 'urls.json'))
+  urls[url] = download_hash
+  __write_json(os.path.join(cache_folder, 'urls.json'), urls)
+  return __get_download_path(download_hash), download_hash
+
+def __build_python_layer(download_path, zip_path, packages, runtime, prepare_function, import_check):
+  # Work in a temporary directory, through full paths so other builds can run at the same time
+  td = tempfile.mkdtemp()
+
+  try:
+    with tarfile.open(download_path) as tar: tar.extractall(td)
+    source_folder = os.path.join(td, os.listdir(td)[0]) # Source distributions hold a single top folder
+
+    # Top folder for Lambda Layer expects 'python', only the packages are needed there
+    layer_folder = os.path.join(td, 'layer', 'python')
+    for package in packages:
+      shutil.copytree(os.path.join(source_folder, package), os.path.join(layer_folder, package),
+        ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+
+    # Add or remove content before compiling it
+    if prepare_function is not None: prepare_function(layer_folder)
+
+    interpreter = __get_interpreter(runtime)
+    source_import_time = __time_import(interpreter, layer_folder, import_check)
+    __compile(interpreter, layer_folder)
+
+    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+    __zip_folder(zip_path + ".tmp", layer_folder, 'python')
+    os.replace(zip_path + ".tmp", zip_path)
+
+    __print_layer_report(zip_path, layer_folder, import_check, source_import_time,
+      __time_import(interpreter, layer_folder, import_check))
+  finally:
+    # Delete the temporary directory and contents
+    shutil.rmtree(td)
+
+# Bytecode is only valid for the version of Python that compiled it, so the interpreter must match the runtime
+def __get_interpreter(runtime):
+  if runtime == "python{}.{}".format(*sys.version_info[:2]): return sys.executable
+  interpreter = shutil.which(runtime)
+  if interpreter is None: print("No '{}' interpreter found, the layer will not have precompiled bytecode".format(runtime))
+  return interpreter
+
+def __compile(interpreter, folder):
+  if interpreter is None: return
+  # Layers are zipped with fixed dates, so the bytecode is checked by the hash of its source rather than
+  # by date. Unchecked as layer content never changes once deployed.
+  subprocess.run([interpreter, "-m", "compileall", "-q", "-j", "0", "--invalidation-mode", "unchecked-hash", folder],
+    check=True)
+
+# Seconds to run the statement in a fresh interpreter with the layer on its path, None if it cannot be measured
+def __time_import(interpreter, folder, import_check):
+  if interpreter is None or import_check is None: return None
+  code = "import sys, time; sys.path.insert(0, {!r}); start = time.perf_counter(); {}; print(time.perf_counter() - start)"
+  result = subprocess.run([interpreter, "-I", "-B", "-c", code.format(folder, import_check)], capture_output=True,
+    text=True)
+  if result.returncode != 0:
+    print("Unable to time '{}' on the layer: {}".format(import_check, result.stderr.strip()))
+    return None
+  return float(result.stdout)
+
+def __print_layer_report(zip_path, folder, import_check, source_import_time, compiled_import_time):
+  files = [os.path.join(base, f) for base, dirs, file_names in os.walk(folder) for f in file_names]
+  print("Built layer '{}': {:.1f} MB zipped, {:.1f} MB unzipped, {} files".format(os.path.basename(zip_path),
+    os.path.getsize(zip_path)/1024/1024, sum(os.path.getsize(f) for f in files)/1024/1024, len(files)))
+  if compiled_import_time is not None:
+    print("'{}' takes {:.0f} ms from source and {:.0f} ms with precompiled bytecode".format(import_check,
+      (source_import_time or 0)*1000, compiled_import_time*1000))
+
+def __get_download_path(download_hash):
+  return os.path.join(cache_folder, 'downloads', download_hash)
+
+def __load_json(file_path):
+  try:
+    with open(file_path) as f: return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def __write_json(file_path, data):
+  os.makedirs(os.path.dirname(file_path), exist_ok=True)
+  with open(file_path + ".tmp", 'w') as f: json.dump(data, f, indent=2)
+  os.replace(file_path + ".tmp", file_path)
+
 def __upload_file(file_name, bucket, object_name=None):
     # If S3 object_name was not specified, use file_name
     if object_name is None: object_name = os.path.basename(file_name)
 
-    s3.upload_file(file_name, bucket, object_name)
-    
-    # Wait until completion
-    waiter = s3.get_waiter('object_exists')
-    waiter.wait(Bucket=bucket, Key=object_name)
+    s3.upload_file(file_name, bucket, object_name) # Returns once the object is stored
 
-def __zip_folder(foldername, target_dir):            
-    zipobj = zipfile.ZipFile(foldername, 'w', zipfile.ZIP_DEFLATED)
+def __zip_folder(foldername, target_dir, archive_dir):            
     rootlen = len(target_dir) + 1
-    for base, dirs, files in os.walk(target_dir):
-        for file in files:
+    files = []
+    for base, dirs, file_names in os.walk(target_dir):
+        for file in file_names:
             fn = os.path.join(base, file)
-            zipobj.write(fn, target_dir+"/"+fn[rootlen:])
\ No newline at end of file
+            files.append((fn, archive_dir+"/"+fn[rootlen:]))
+    with open(foldername, 'wb') as f: __write_zip(f, files)
+
+def __get_zip(files):
+  data = io.BytesIO()
+  __write_zip(data, files)
+  return data.getvalue()
+
+# Writes (path, name in the zip) entries in name order with fixed dates and modes, so the zip only depends on
+# the content of the files
+def __write_zip(fileobj, files):
+  with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zipobj:
+    for path, arcname in sorted(files, key=lambda f: f[1]):
+      info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+      info.external_attr = ZIP_FILE_MODE
+      info.compress_type = zipfile.ZIP_DEFLATED
+      with open(path, 'rb') as f: zipobj.writestr(info, f.read())
\ No newline at end of file
@@ -0,0 +1,51 @@
+import json, logging, os
+from collections import OrderedDict
+import metrics # Packaged from microservices/staging_er7
+
+logger = logging.getLogger()
+
+# Duplicate detection kept in the warm container, in front of the table of received messages:
+#   'seen'  the key was accepted or found in the table by this container, no need to ask the table
+#   'maybe' the key could have been seen elsewhere, the caller claims it in the table
+# Hits, misses and the misses found in the table are counted as metrics as well as logged.
+SEEN = 'seen'
+MAYBE = 'maybe'
+
+max_recent = int(os.environ.get('dedup_cache_size', '10000'))
+stats_interval = int(os.environ.get('dedup_stats_interval', '100')) # Log the stats every this many checks
+
+recent = OrderedDict() # Least recently used first
+stats = {'checks': 0, 'seen': 0, 'maybe': 0, 'confirmed': 0}
+
+def check(key):
+  stats['checks'] += 1
+
+  if key in recent:
+    recent.move_to_end(key)
+    status = SEEN
+  else:
+    status = MAYBE
+
+  stats[status] += 1
+  metrics.count('dedup_cache_hit' if status == SEEN else 'dedup_cache_miss')
+  if stats['checks'] % stats_interval == 0: logger.info("Dedup cache: {}".format(json.dumps(get_stats())))
+  return status
+
+# Remembers a key that is now known to be in the table
+def add(key):
+  recent[key] = True
+  recent.move_to_end(key)
+  while len(recent) > max_recent: recent.popitem(last=False)
+
+# Records that a key the cache did not know about was found in the table
+def confirm(key):
+  stats['confirmed'] += 1
+  metrics.count('dedup_cache_confirmed')
+  add(key)
+
+def get_stats():
+  checks = stats['checks'] or 1
+  return dict(stats,
+    size=len(recent),
+    hit_rate=round(stats['seen'] / checks, 4), # Answered locally as duplicates
+    table_duplicate_rate=round(stats['confirmed'] / max(stats['maybe'], 1), 4)) # Found only in the table
@@ -1,79 +1,276 @@
-import boto3, json, os, logging, base64
-import hashlib
-from boto3.dynamodb.conditions import Key, Attr
+import json, os, logging
+import startup # Packaged from microservices/staging_er7, imported first so the init time covers the rest
+import log_util, metrics # Packaged from microservices/staging_er7
+with startup.timed('import:boto3'):
+  from botocore.exceptions import ClientError
+import dedup_cache, idempotency, payload
+import er7_view # Packaged from microservices/staging_er7
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(log_util.level)
 
-# Initialize clients outside of the main function to reuse between calls
-sns = boto3.client('sns')
-table = boto3.resource('dynamodb').Table(os.environ['table'])
+# Clients are reused between calls, every request needs them so they are created during init
+sns = startup.client('sns')
+table = startup.table(os.environ['table'])
+startup.preload(sns, table)
 
+BATCH_ROUTE = 'POST /er7/batch'
+max_batch_size = int(os.environ.get('max_batch_size', '500')) # Most messages accepted in one batch call
+PUBLISH_BATCH_SIZE = 10 # Most entries SNS accepts in one PublishBatch call
+PUBLISH_BATCH_BYTES = 262144 # Most bytes SNS accepts across all entries of one PublishBatch call
+
+@startup.handler
 def lambda_handler(event, context):
+  payload.start_request()
+  try:
+    if event.get('routeKey') == BATCH_ROUTE: return __handle_batch(event)
+    return __handle_message(event)
+  finally:
+    logger.info("Request memory: {}".format(payload.get_memory()))
+
+def __handle_message(event):
   # Extract data from the event  
   idToken = event['headers']['authorization']
   b64_msg = json.loads(event["body"])['msg'] 
-  msg = __decode_from_base64 (b64_msg, 'utf-8')
   owner = event['requestContext']['authorizer']['jwt']['claims'].get('custom:write')
 
   # Verify authZ
   if owner == None:
     logger.warn("Unauthorized write attempt rejected")
+    metrics.count('unauthorized')
     return __get_response(403, "Insufficient privileges to write")
-  logger.debug("Owner: "+owner)
+  logger.debug("Owner: %s", owner)
+
+  # Messages that are not valid base64 or UTF-8 are rejected before anything is claimed for them
+  try:
+    data, msg_hash = payload.decode(b64_msg) # Hashed while decoding
+    msg = payload.get_text(data)
+  except (ValueError, TypeError):
+    logger.warn("Undecodable message rejected")
+    metrics.count('invalid', source=owner)
+    return __get_response(400, "Unable to decode message")
+  del b64_msg
+  metrics.add('message_bytes', len(data), 'Bytes', source=owner)
   
-  # Check hash against unique 
-  msg_hash = hashlib.sha256(msg.encode()).hexdigest()
-  count = table.query(KeyConditionExpression=Key('message_hash').eq(msg_hash))['Count']
-    
-  if count > 0:
+  # Claim the hash in the table unless the local cache already knows it, the claim is the only check needed
+  # and holds off copies that arrive while this one is published
+  key = {'message_hash': msg_hash}
+  holder = {} if dedup_cache.check(msg_hash) == dedup_cache.SEEN else None # Seen here, without its result
+  if holder is None:
+    with metrics.timed('dedup_claim', source=owner):
+      holder = idempotency.claim(table, key)
+
+  if holder is not None:
+    if idempotency.get_state(holder) == idempotency.COMPLETED: dedup_cache.confirm(msg_hash)
     logger.warn("Duplicate message ignored")
-    return __get_response(400, "Rejected due to being a duplicate")
+    metrics.count('duplicate', source=owner)
+    return __get_response(400, "Rejected due to being a duplicate", original=__get_original(holder))
+  logger.debug("Message hash claimed in DynamoDB table")
 
   # Publish to pub-sub-hub
-  sns.publish(
-    TopicArn=os.environ['topic'],
-    Message=msg,
-    MessageAttributes={
-      'event': {
-        'DataType': 'String',
-        'StringValue': 'ingested',
-      },
-      'protocol': {
-        'DataType': 'String',
-        'StringValue': 'hl7v2',
-      },
-      'format': {
-        'DataType': 'String',
-        'StringValue': 'er7',
-      },
-      'source': {
-        'DataType': 'String',
-        'StringValue': owner,
-      }
-    }
-  )
+  message_type = er7_view.get_message_type(msg)
+  try:
+    with metrics.timed('publish', source=owner, message_type=message_type):
+      sns.publish(
+        TopicArn=os.environ['topic'],
+        Message=msg,
+        MessageAttributes=__get_message_attributes(owner, message_type)
+      )
+  except Exception:
+    idempotency.fail(table, key) # Let the message be sent again
+    raise
   logger.info("Published to SNS topic")
-  
-  # Update DynamoDB received message table
-  table.put_item(
-    Item={
-      'message_hash': msg_hash
-    }
-  )
-  logger.debug("Message hash written to DynamoDB table")
+  metrics.count('ingested', source=owner, message_type=message_type)
+  dedup_cache.add(msg_hash)
 
+  # The message is out, if its claim cannot be completed it lapses and only copies sent after that get through
+  try:
+    with metrics.timed('dedup_complete', source=owner):
+      idempotency.complete(table, key, {'status': 'Message ingested', 'message_type': message_type or ''})
+  except ClientError as e:
+    logger.error("Unable to complete the claim of message {}: {}".format(msg_hash, e))
   return __get_response(201, 'Message ingested')
+
+# Ingests many messages with one bulk lookup, bulk publishes and bulk writes, reporting a status per message
+def __handle_batch(event):
+  owner = event['requestContext']['authorizer']['jwt']['claims'].get('custom:write')
+
+  # Verify authZ
+  if owner == None:
+    logger.warn("Unauthorized write attempt rejected")
+    metrics.count('unauthorized')
+    return __get_response(403, "Insufficient privileges to write")
+  logger.debug("Owner: %s", owner)
+
+  try:
+    b64_msgs = __get_batch_messages(event)
+  except (ValueError, KeyError, TypeError):
+    return __get_response(400, "Body must be a JSON array or NDJSON of messages")
+  if len(b64_msgs) > max_batch_size:
+    return __get_response(413, "Batch exceeds {} messages".format(max_batch_size))
+
+  # Decode and hash every message, the first copy of a message within the batch is the one ingested
+  results = [None] * len(b64_msgs)
+  candidates = {} # Hash -> (position, message)
+  message_bytes = {} # Position -> size of the message in bytes
+  for i, b64_msg in enumerate(b64_msgs):
+    try:
+      data, msg_hash = payload.decode(b64_msg)
+      msg = payload.get_text(data) # Copied out as the next message reuses the buffer
+    except (ValueError, TypeError):
+      results[i] = __get_result(i, 400, "Unable to decode message")
+      metrics.count('invalid', source=owner)
+      continue
+    metrics.add('message_bytes', len(data), 'Bytes', source=owner)
+
+    if msg_hash in candidates or dedup_cache.check(msg_hash) == dedup_cache.SEEN:
+      results[i] = __get_result(i, 400, "Rejected due to being a duplicate")
+      metrics.count('duplicate', source=owner)
+    else:
+      candidates[msg_hash] = (i, msg)
+      message_bytes[str(i)] = len(data)
+
+  # Claim all remaining hashes at the same time, each claim is a conditional write of its own
+  with metrics.timed('dedup_claim', source=owner):
+    holders = __claim_all(list(candidates))
+  for msg_hash, holder in holders.items():
+    if holder is None: continue
+    i, msg = candidates.pop(msg_hash)
+    if isinstance(holder, Exception):
+      logger.error("Unable to claim message {}: {}".format(msg_hash, holder))
+      results[i] = __get_result(i, 500, "Unable to claim message")
+      continue
+    if idempotency.get_state(holder) == idempotency.COMPLETED: dedup_cache.confirm(msg_hash)
+    results[i] = __get_result(i, 400, "Rejected due to being a duplicate", __get_original(holder))
+    metrics.count('duplicate', source=owner)
+  if len(results) - len(candidates) > 0: logger.warn("Duplicate or invalid messages ignored")
+
+  # Publish to pub-sub-hub, then complete the claims of the messages that were published
+  published = []
+  entries = [{'Id': str(i), 'Message': msg, 'MessageAttributes': __get_message_attributes(owner, er7_view.get_message_type(msg))}
+    for i, msg in candidates.values()]
+  with metrics.timed('publish', source=owner):
+    failed_ids = __publish_batch(entries, message_bytes)
+  for msg_hash, (i, msg) in candidates.items():
+    if str(i) in failed_ids:
+      idempotency.fail(table, {'message_hash': msg_hash}) # Let the message be sent again
+      results[i] = __get_result(i, 500, "Unable to publish message")
+    else:
+      published.append(msg_hash)
+      results[i] = __get_result(i, 201, "Message ingested")
+  logger.info("Published {} message(s) to SNS topic".format(len(published)))
+  for entry in entries:
+    message_type = entry['MessageAttributes'].get('message_type', {}).get('StringValue')
+    outcome = 'publish_failed' if entry['Id'] in failed_ids else 'ingested'
+    metrics.count(outcome, source=owner, message_type=message_type)
+
+  for msg_hash in published: dedup_cache.add(msg_hash)
+
+  # The messages are out, claims that cannot be completed lapse as in the single message route
+  try:
+    with metrics.timed('dedup_complete', source=owner):
+      idempotency.complete_all(table, [{'message_hash': h} for h in published], {'status': 'Message ingested'})
+    logger.debug("Message claims completed in DynamoDB table")
+  except ClientError as e:
+    logger.error("Unable to complete the claims of {} published message(s): {}".format(len(published), e))
+
+  return __get_response(200, "Batch processed", results)
+
+# Accepts a JSON array, an object with a 'msgs' array, or NDJSON with one message per line
+def __get_batch_messages(event):
+  body = event['body']
+  if event.get('isBase64Encoded'): body = payload.get_text(payload.decode(body)[0])
+
+  try:
+    items = json.loads(body)
+  except ValueError:
+    items = [json.loads(line) for line in body.splitlines() if line.strip()]
+  if isinstance(items, dict): items = items['msgs'] if 'msgs' in items else [items]
+
+  # Each item is either the base64 message itself or an object like the single message route takes
+  return [item if isinstance(item, str) else item['msg'] for item in items]
+
+# Hash -> None for the claims taken, the item of the copy holding it, or the error that kept it from being claimed
+def __claim_all(msg_hashes):
+  futures = [startup.get_executor().submit(idempotency.claim, table, {'message_hash': h}) for h in msg_hashes]
+  return {h: future.exception() or future.result() for h, future in zip(msg_hashes, futures)}
+
+# Publishes entries in batches sent at the same time and returns the ids of the ones that could not be
+# published. A batch that fails only fails its own messages, the others are still recorded as published.
+def __publish_batch(entries, message_bytes={}):
+  batches = __get_publish_batches(entries, message_bytes)
+  return set().union(*startup.get_executor().map(__publish_entries, batches))
+
+def __publish_entries(batch):
+  try:
+    response = sns.publish_batch(TopicArn=os.environ['topic'], PublishBatchRequestEntries=batch)
+  except ClientError as e:
+    logger.error("Unable to publish batch to SNS topic: {}".format(e))
+    return {entry['Id'] for entry in batch}
+
+  for failure in response.get('Failed', []):
+    logger.error("Unable to publish message {}: {}".format(failure['Id'], failure.get('Message')))
+  return {failure['Id'] for failure in response.get('Failed', [])}
+
+# Groups entries up to the SNS limits on count and total size of a batch, sizes already known are not measured again
+def __get_publish_batches(entries, message_bytes={}):
+  batch, batch_bytes = [], 0
+  for entry in entries:
+    size = message_bytes.get(entry['Id'])
+    entry_bytes = (len(entry['Message'].encode()) if size is None else size) + sum(len(name) + len(a['DataType']) + len(a['StringValue'].encode())
+      for name, a in entry['MessageAttributes'].items())
+    if batch and (len(batch) == PUBLISH_BATCH_SIZE or batch_bytes + entry_bytes > PUBLISH_BATCH_BYTES):
+      yield batch
+      batch, batch_bytes = [], 0
+    batch.append(entry)
+    batch_bytes += entry_bytes
+  if batch: yield batch
+
+def __get_message_attributes(owner, message_type=None):
+  attributes = {
+    'event': {
+      'DataType': 'String',
+      'StringValue': 'ingested',
+    },
+    'protocol': {
+      'DataType': 'String',
+      'StringValue': 'hl7v2',
+    },
+    'format': {
+      'DataType': 'String',
+      'StringValue': 'er7',
+    },
+    'source': {
+      'DataType': 'String',
+      'StringValue': owner,
+    }
+  }
+
+  # Lets subscribers filter on the type of message without parsing it
+  if message_type:
+    attributes['message_type'] = {
+      'DataType': 'String',
+      'StringValue': message_type,
+    }
+  return attributes
+
+def __get_result(position, code, description, original=None):
+  result = {'index': position, 'statusCode': code, 'status': description}
+  if original is not None: result['original'] = original
+  return result
   
-def __get_response(code, description):
+# What became of the copy of the message that was ingested first, as far as the table tells
+def __get_original(holder):
+  return dict(holder.get('result') or {}, state=idempotency.get_state(holder))
+
+def __get_response(code, description, results=None, original=None):
+  body = {"status": description}
+  if results is not None: body['results'] = results
+  if original is not None: body['original'] = original
+
   return {
     'statusCode': code, 
-    "body": json.dumps({
-      "status": description
-    })
+    "body": json.dumps(body)
   }
 
-def __decode_from_base64(encoded_message, encoding):
-  base64_bytes = encoded_message.encode(encoding)
-  message_bytes = base64.b64decode(base64_bytes)
-  return message_bytes.decode(encoding)
\ No newline at end of file
+startup.ready()
@@ -10,7 +10,11 @@ template_file_path = local_folder + "/front_door_stack.yml"
 def deploy(stack_name, core_stack_name, wait=False):
   # Sync our lambda function
   artifact_bucket_name = cf_util.get_physical_resource_id(core_stack_name, "ArtifactBucket")
-  key, version = lambda_util.sync_lambda_function(local_folder+"/front_door_lambda.py", artifact_bucket_name)
+  key, version = lambda_util.sync_lambda_function(local_folder+"/front_door_lambda.py", artifact_bucket_name,
+    [local_folder+"/dedup_cache.py", local_folder+"/idempotency.py", local_folder+"/payload.py",
+      local_folder+"/../staging_er7/er7_view.py",
+      local_folder+"/../staging_er7/startup.py", local_folder+"/../staging_er7/log_util.py",
+      local_folder+"/../staging_er7/metrics.py"])
   
   params = {
     'CoreStack':core_stack_name,
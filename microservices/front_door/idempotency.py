@@ -0,0 +1,65 @@
+import os, time
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+# Claims on messages in a DynamoDB table, taken with a single conditional write before a message is processed.
+# claim_state is one of
+#   in_flight   a request is processing the message, its claim lapses at lease_until if it never finishes
+#   completed   processed, later copies get back the result stored with it
+#   failed      processing failed, the next copy takes the claim over
+# Items expire through the table's TTL on expires_at. Items written before claims existed count as completed.
+IN_FLIGHT = 'in_flight'
+COMPLETED = 'completed'
+FAILED = 'failed'
+ttl_seconds = int(float(os.environ.get('dedup_ttl_days', '30')) * 86400)
+lease_seconds = int(os.environ.get('dedup_lease_seconds', '120')) # Longer than the function runs
+deserializer = TypeDeserializer()
+
+# Claims the message with one conditional write. Returns None when the claim was taken, or the item of the copy
+# holding it. Extra attributes (e.g. a status for senders to poll) are written with the claim.
+def claim(table, item_key, **attributes):
+  now = int(time.time())
+  item = dict(item_key, claim_state=IN_FLIGHT, lease_until=now + lease_seconds, expires_at=now + ttl_seconds)
+  item.update(attributes)
+
+  try:
+    table.put_item(
+      Item=item,
+      ConditionExpression="attribute_not_exists(#key) OR claim_state = :failed OR expires_at < :now OR "
+        "(claim_state = :in_flight AND lease_until < :now)",
+      ExpressionAttributeNames={"#key": next(iter(item_key))},
+      ExpressionAttributeValues={':failed': FAILED, ':in_flight': IN_FLIGHT, ':now': now},
+      ReturnValuesOnConditionCheckFailure='ALL_OLD'
+    )
+    return None
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException': raise
+    # The item comes back in the low level format, even through a Table resource
+    return {name: deserializer.deserialize(value) for name, value in e.response.get('Item', {}).items()}
+
+def complete(table, item_key, result={}, **attributes):
+  __set_state(table, item_key, COMPLETED, dict(attributes, result=result))
+
+# Lets the next copy of the message take the claim over
+def fail(table, item_key, **attributes):
+  __set_state(table, item_key, FAILED, attributes)
+
+# Completes many claims at once, the writer groups items and resends unprocessed ones. The items are replaced
+# as a whole, which is fine for claims held by the caller.
+def complete_all(table, keys, result={}):
+  expires_at = int(time.time()) + ttl_seconds
+  with table.batch_writer() as batch:
+    for key in keys: batch.put_item(Item=dict(key, claim_state=COMPLETED, expires_at=expires_at, result=result))
+
+def get_state(item):
+  return item.get('claim_state', COMPLETED)
+
+def __set_state(table, item_key, state, attributes):
+  attributes = dict(attributes, claim_state=state, expires_at=int(time.time()) + ttl_seconds)
+  names = {'#a{}'.format(i): name for i, name in enumerate(attributes)}
+  table.update_item(
+    Key=item_key,
+    UpdateExpression="SET " + ", ".join("{0} = :{1}".format(placeholder, placeholder[1:]) for placeholder in names),
+    ExpressionAttributeNames=names,
+    ExpressionAttributeValues={':' + placeholder[1:]: attributes[name] for placeholder, name in names.items()}
+  )
@@ -0,0 +1,57 @@
+import binascii, hashlib, os, re, resource, threading, tracemalloc
+
+# Decodes base64 payloads a chunk at a time into a buffer kept by the warm container. Large messages (e.g.
+# documents embedded in OBX-5) are then held once as bytes rather than as several full copies of text and bytes.
+CHUNK_CHARS = 256*1024 # Multiple of 4 so each chunk decodes on its own
+NOT_BASE64 = re.compile(r'[^A-Za-z0-9+/=]') # Skipped by the decoder, removed first so they cannot shift the chunks
+max_shared_buffer = int(os.environ.get('payload_buffer_bytes', str(8*1024*1024))) # Larger payloads get their own buffer
+trace_memory = os.environ.get('payload_trace_memory', 'false').lower() == 'true' # Exact but slower peak tracking
+
+local = threading.local() # Buffer of each thread, the handler may be called from several at once
+rss_at_start = 0
+
+# The one definition of a message hash: SHA-256 of the decoded message bytes
+def get_hash(data):
+  return hashlib.sha256(data).hexdigest()
+
+# Returns a memoryview of the decoded bytes and their hash. The view is only valid until the thread's next call.
+def decode(b64_text):
+  if not str.isascii(b64_text): raise ValueError("Payload is not base64") # As base64.b64decode rejects it
+  if NOT_BASE64.search(b64_text): b64_text = NOT_BASE64.sub('', b64_text)
+
+  size = len(b64_text) // 4 * 3
+  if size > max_shared_buffer: buffer = bytearray(size)
+  else:
+    buffer = getattr(local, 'buffer', None)
+    if buffer is None or len(buffer) < size: buffer = local.buffer = bytearray(size)
+
+  view = memoryview(buffer)
+  written = 0
+  for start in range(0, len(b64_text), CHUNK_CHARS):
+    chunk = binascii.a2b_base64(b64_text[start:start+CHUNK_CHARS])
+    view[written:written+len(chunk)] = chunk
+    written += len(chunk)
+
+  data = view[:written]
+  return data, get_hash(data)
+
+# Text of the decoded message, read straight from the buffer
+def get_text(data, encoding='utf-8'):
+  return str(data, encoding)
+
+def start_request():
+  global rss_at_start
+  rss_at_start = __get_rss_kb()
+  if trace_memory:
+    if not tracemalloc.is_tracing(): tracemalloc.start()
+    tracemalloc.reset_peak()
+
+# Peak memory of the current request, the process peak only shows growth over what earlier requests reached
+def get_memory():
+  memory = {'rss_peak_kb': __get_rss_kb(), 'rss_growth_kb': __get_rss_kb() - rss_at_start,
+    'buffer_kb': len(getattr(local, 'buffer', b'')) // 1024}
+  if trace_memory: memory['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+  return memory
+
+def __get_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Kilobytes on Linux
@@ -0,0 +1,108 @@
+import codecs, re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import er7_view, startup
+
+# Reads HL7 batch files one chunk at a time and yields the messages they hold:
+#   FHS  file header      BHS  batch header      MSH...  messages
+#   BTS  batch trailer (BTS-1: messages in the batch)      FTS  file trailer (FTS-1: batches in the file)
+# Files without the envelope (just MSH after MSH) are read the same way.
+CHUNK_SIZE = 1024*1024
+SEPARATORS = re.compile(r'[\r\n]+') # Segments end with \r, exports often use \n or \r\n
+ENVELOPE = ('FHS', 'BHS', 'BTS', 'FTS')
+
+s3 = startup.client('s3') # Only created when reading from S3
+
+def read_file(path, chunk_size=CHUNK_SIZE):
+  with open(path, encoding='utf-8', newline='') as f: # Keep \r as it is
+    for chunk in iter(lambda: f.read(chunk_size), ''): yield chunk
+
+def read_s3(bucket, key, chunk_size=CHUNK_SIZE):
+  decoder = codecs.getincrementaldecoder('utf-8')() # A character can span two chunks
+  for chunk in s3.get_object(Bucket=bucket, Key=key)['Body'].iter_chunks(chunk_size):
+    yield decoder.decode(chunk)
+  yield decoder.decode(b'', final=True)
+
+def iter_segments(chunks):
+  rest = ''
+  for chunk in chunks:
+    segments = SEPARATORS.split(rest + chunk)
+    rest = segments.pop() # May continue in the next chunk
+    for segment in segments:
+      if segment.strip(): yield segment
+  if rest.strip(): yield rest
+
+# Yields each message as ER7 text, the envelope segments are counted in the summary as they go by
+def iter_messages(segments, summary):
+  summary.update({'messages': 0, 'batches': [], 'file_batch_count': None, 'ignored_segments': 0})
+  message = []
+  for segment in segments:
+    name = segment[:3]
+    if name == 'MSH' or name in ENVELOPE:
+      if message: yield "\r".join(message)
+      message = []
+
+    if name == 'MSH':
+      message.append(segment)
+      summary['messages'] += 1
+      if summary['batches']: summary['batches'][-1]['messages'] += 1
+    elif name == 'BHS':
+      summary['batches'].append({'messages': 0, 'trailer_count': None})
+    elif name == 'BTS' and summary['batches']:
+      summary['batches'][-1]['trailer_count'] = __get_count(segment)
+    elif name == 'FTS':
+      summary['file_batch_count'] = __get_count(segment)
+    elif message:
+      message.append(segment)
+    elif name != 'FHS':
+      summary['ignored_segments'] += 1 # Outside of any message
+  if message: yield "\r".join(message)
+
+# True when the counts in the trailers match what was read, trailers that are missing are not checked
+def check_trailers(summary):
+  if summary['file_batch_count'] is not None and summary['file_batch_count'] != len(summary['batches']): return False
+  return all(b['trailer_count'] is None or b['trailer_count'] == b['messages'] for b in summary['batches'])
+
+# Runs execute on every message with at most max_in_flight messages read ahead, and hands the results to publish
+# in groups as they come back in message order. execute returns an entry to publish or None when it fails,
+# publish returns the ids of the entries it could not publish. Yields a status per message.
+def run(messages, execute, publish, max_workers=10, max_in_flight=100, publish_size=10):
+  in_flight = deque()
+  pending = [] # (status, entry) waiting to be published
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    for position, er7 in enumerate(messages):
+      in_flight.append((__get_status(position, er7), executor.submit(execute, position, er7)))
+      if len(in_flight) >= max_in_flight: pending.append(__get_result(*in_flight.popleft()))
+      if len(pending) >= publish_size:
+        yield from __publish(pending, publish)
+        pending = []
+
+    while in_flight: pending.append(__get_result(*in_flight.popleft()))
+  yield from __publish(pending, publish)
+
+def __get_result(status, future):
+  entry = future.result()
+  if entry is None: status['status'] = 'failed'
+  else: status['status'] = entry['MessageAttributes']['event']['StringValue']
+  return status, entry
+
+def __publish(pending, publish):
+  failed_ids = publish([entry for status, entry in pending if entry is not None])
+  for status, entry in pending:
+    if entry is not None and entry['Id'] in failed_ids: status['status'] = 'failed'
+    yield status
+
+def __get_status(position, er7):
+  try:
+    control_id = er7_view.Er7View(er7)['MSH.10']
+  except ValueError:
+    control_id = None
+  return {'index': position, 'control_id': control_id, 'status': None}
+
+def __get_count(segment):
+  fields = segment.split(segment[3]) if len(segment) > 3 else []
+  try:
+    return int(fields[1]) if len(fields) > 1 and fields[1].strip() else None
+  except ValueError:
+    return None
@@ -0,0 +1,213 @@
+import re
+import er7_view, structure_index
+
+# Native ER7 parse engine: yields segments as a stream and splits fields, repetitions, components and
+# subcomponents only where the HL7 structure needs them, producing the same JSON as parse_er7_lambda
+# does through the hl7apy object tree. Structure definitions come from the precompiled structure index.
+SEGMENT_SEPARATOR = '\r'
+escape_regex_cache = {}
+
+def get_message_info(er7, encoding_chars):
+  end = er7.find(SEGMENT_SEPARATOR)
+  msh_fields = (er7 if end == -1 else er7[:end]).split(encoding_chars['FIELD'])
+
+  # Split the MSH like hl7apy does: index n holds MSH-(n+1)
+  message_structure = None
+  if len(msh_fields) > 8:
+    message_type = msh_fields[8].strip().split(encoding_chars['COMPONENT'])
+    if len(message_type) > 2: message_structure = message_type[2]
+    elif len(message_type) > 1: message_structure = "{}_{}".format(message_type[0], message_type[1])
+
+  version = None
+  if len(msh_fields) > 11:
+    version = msh_fields[11].strip().split(encoding_chars['COMPONENT'])[0]
+
+  return message_structure, version or structure_index.DEFAULT_VERSION
+
+# Yield segments one at a time without splitting the whole message up front
+def iter_segments(er7):
+  start = 0
+  length = len(er7)
+  while start < length:
+    end = er7.find(SEGMENT_SEPARATOR, start)
+    if end == -1: end = length
+    if end > start: yield er7[start:end]
+    start = end + 1
+
+def split_fields(segment, encoding_chars):
+  # MSH-1 is the field separator itself, so MSH fields start right after the segment name
+  if segment[:3] == 'MSH': return segment[3:].split(encoding_chars['FIELD'])
+  return segment[4:].split(encoding_chars['FIELD'])
+
+def to_json(er7):
+  er7 = er7.lstrip()
+  encoding_chars = er7_view.get_encoding_chars(er7)
+  message_structure, version = get_message_info(er7, encoding_chars)
+  index = structure_index.load_index(version)
+
+  if message_structure not in index['messages']:
+    raise KeyError(message_structure)
+
+  json_msg = {}
+  root = __new_node(None, index['groups'][message_structure], None, json_msg)
+  __add_segments(root, iter_segments(er7), encoding_chars, index)
+  return json_msg
+
+# Places segments in their groups following the same rules as hl7apy.parser.parse_segments
+def __add_segments(root, segments, encoding_chars, index):
+  parents = [(None, root['structure'])]
+  current = root
+
+  for segment in segments:
+    segment_name = segment[:3]
+
+    for _ in range(len(parents)):
+      if not __find_segment(segment_name, parents, index):
+        if current is not root:
+          parents.pop()
+          current = current['parent']
+        continue
+
+      if parents[-1][0] != current['name']:
+        # Open every group between the current parent and the segment
+        start = 0
+        for i, (name, structure) in enumerate(parents):
+          if name == current['name'] and structure is current['structure']:
+            start = i
+            break
+        for name, structure in parents[start+1:]:
+          current = __add_group(current, name, structure)
+      elif current is not root and segment_name in current['children'] and \
+          current['structure'][segment_name][0] == 1:
+        # A non-repeating segment that was already seen starts a new instance of the group
+        current = __add_group(current['parent'], current['name'], current['structure'])
+
+      __add_segment(current, segment.strip(), encoding_chars, index)
+      break
+
+def __find_segment(segment_name, parents, index):
+  groups = []
+  for name, (max_repetitions, kind) in parents[-1][1].items():
+    if kind == 'SEG' and name == segment_name: return True
+    elif kind == 'GRP': groups.append((name, index['groups'][name]))
+
+  for group in groups:
+    parents.append(group)
+    if __find_segment(segment_name, parents, index): return True
+    parents.pop()
+
+  return False
+
+def __new_node(name, structure, parent, data):
+  return {'name': name, 'structure': structure, 'parent': parent, 'data': data, 'children': set()}
+
+def __add_group(parent, name, structure):
+  group = __new_node(name, structure, parent, {})
+  __add_to_parent(parent['data'], name, parent['structure'][name][0], group['data'])
+  parent['children'].add(name)
+  return group
+
+def __add_segment(parent, segment, encoding_chars, index):
+  segment_name = segment[:3]
+  segment_data = {}
+  __add_to_parent(parent['data'], segment_name, parent['structure'][segment_name][0], segment_data)
+  parent['children'].add(segment_name)
+
+  field_sep = encoding_chars['FIELD']
+  repetition_sep = encoding_chars['REPETITION']
+  children = index['segments'].get(segment_name, {})
+
+  for i, field in enumerate(split_fields(segment, encoding_chars)):
+    field_name = "{}_{}".format(segment_name, i+1)
+
+    if field_name == 'MSH_1':
+      segment_data[field_name] = field_sep
+      continue
+    if not field.strip(): continue
+
+    field_info = __get_element(children, index['fields'], field_name)
+    if field_info is None:
+      raise Exception("Field with value {} not found in this version of HL7".format(field))
+
+    if field_name == 'MSH_2':
+      segment_data[field_name] = field
+    elif repetition_sep in field:
+      for repetition in field.split(repetition_sep):
+        __add_field(segment_data, field_name, field_info, repetition, encoding_chars, index)
+    else:
+      __add_field(segment_data, field_name, field_info, field, encoding_chars, index)
+
+def __add_field(segment_data, field_name, field_info, text, encoding_chars, index):
+  is_leaf, max_repetitions, datatype = field_info
+  if is_leaf:
+    segment_data[field_name] = __get_leaf_value(text, encoding_chars)
+    return
+
+  if max_repetitions is None: raise KeyError(field_name)
+  field_data = {}
+  __add_to_parent(segment_data, field_name, max_repetitions, field_data)
+
+  component_sep = encoding_chars['COMPONENT']
+  components = text.split(component_sep) if component_sep in text else [text]
+  children = index['datatypes'].get(datatype, {})
+
+  for i, component in enumerate(components):
+    if not component.strip(): continue
+    component_name = "{}_{}".format(datatype, i+1)
+
+    component_info = __get_element(children, index['components'], component_name)
+    if component_info is None:
+      raise Exception("Component with value {} not found in this version of HL7".format(
+        __get_leaf_value(component, encoding_chars)))
+
+    is_leaf, max_repetitions, component_datatype = component_info
+    if is_leaf:
+      field_data[component_name] = __get_leaf_value(component, encoding_chars)
+      continue
+
+    if max_repetitions is None: raise KeyError(component_name)
+    component_data = {}
+    __add_to_parent(field_data, component_name, max_repetitions, component_data)
+    __add_subcomponents(component_data, component_datatype, component, encoding_chars, index)
+
+def __add_subcomponents(component_data, datatype, text, encoding_chars, index):
+  subcomponent_sep = encoding_chars['SUBCOMPONENT']
+  subcomponents = text.split(subcomponent_sep) if subcomponent_sep in text else [text]
+
+  for i, subcomponent in enumerate(subcomponents):
+    if not subcomponent.strip(): continue
+    subcomponent_name = "{}_{}".format(datatype, i+1)
+
+    subcomponent_info = index['components'].get(subcomponent_name)
+    if subcomponent_info is None or not subcomponent_info[0]:
+      raise Exception("SubComponent with value {} not found in this version of HL7".format(subcomponent))
+
+    # The hl7apy conversion only keeps subcomponents whose value is an ST instance
+    if subcomponent_info[1] == 'ST' and index['keeps_st']:
+      component_data[subcomponent_name] = subcomponent
+
+def __add_to_parent(parent_data, name, max_repetitions, data):
+  # Unique elements are added directly, repeating ones are collected in a list
+  if max_repetitions == 1:
+    parent_data[name] = data
+  else:
+    if name not in parent_data: parent_data[name] = []
+    parent_data[name].append(data)
+
+# Leaf values match what hl7apy gives back through to_er7, which escapes stray escape characters
+def __get_leaf_value(text, encoding_chars):
+  escape = encoding_chars['ESCAPE']
+  if escape not in text: return text
+
+  if escape not in escape_regex_cache:
+    e = re.escape(escape)
+    escape_regex_cache[escape] = re.compile(r'(?<!{0}[HNFSTRE]){0}(?![HNFSTRE]{0})'.format(e))
+  return escape_regex_cache[escape].sub(lambda m: "{0}E{0}".format(escape), text)
+
+# Looks the element up in its parent, then on its own like hl7apy does for elements outside the definition
+def __get_element(children, elements, name):
+  if name in children: return children[name]
+  if name in elements:
+    is_leaf, datatype = elements[name]
+    return [is_leaf, None, datatype]
+  return None
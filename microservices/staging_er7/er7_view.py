@@ -0,0 +1,134 @@
+import re
+
+# Lazy view of an ER7 message for reading a few values without building the JSON tree:
+#   view = Er7View(er7)
+#   view["MSH.9.1"], view["PID.3.1"], view["OBX[2].5"], view["PID.3[2].1.1"]
+# Paths are SEGMENT[occurrence].field[repetition].component.subcomponent, numbered from 1 like HL7 itself, and
+# occurrences and repetitions default to the first. Segments are indexed only as far as needed to find the one
+# asked for and only the segments read are split. Values are the raw ER7 text, escape sequences included.
+SEGMENT = re.compile(r'[^\r\n]+') # Tolerates \n and \r\n as well, before prepare_er7_lambda has run
+PATH = re.compile(r'^([A-Z][A-Z0-9]{2})(?:\[(\d+)\])?(?:\.(\d+)(?:\[(\d+)\])?(?:\.(\d+)(?:\.(\d+))?)?)?$')
+HEADER_PATHS = {
+  'message_type': 'MSH.9.1',
+  'trigger_event': 'MSH.9.2',
+  'control_id': 'MSH.10',
+  'version': 'MSH.12.1',
+  'sending_facility': 'MSH.4.1',
+  'patient_id': 'PID.3.1'
+}
+
+def get_encoding_chars(er7):
+  # MSH-1 is the character right after 'MSH', MSH-2 holds the remaining delimiters
+  if not er7.startswith('MSH') or len(er7) < 4 or er7[3].isspace():
+    raise ValueError("Invalid message: it does not start with an MSH segment")
+  field_sep = er7[3]
+  end = er7.find(field_sep, 4)
+  seps = er7[4:end] if end != -1 else ''
+
+  if len(seps) < 4:
+    raise ValueError("Missing required encoding characters in MSH-2")
+  if len(set(seps)) != len(seps) or field_sep in seps:
+    raise ValueError("Found duplicate encoding characters in MSH-2")
+
+  return {
+    'FIELD': field_sep,
+    'COMPONENT': seps[0],
+    'REPETITION': seps[1],
+    'ESCAPE': seps[2],
+    'SUBCOMPONENT': seps[3]
+  }
+
+# MSH-9 as one name (e.g. ADT_A01), None for messages that are not valid ER7 or do not have it
+def get_message_type(er7):
+  try:
+    view = Er7View(er7)
+  except ValueError:
+    return None
+  return "_".join(v for v in [view['MSH.9.1'], view['MSH.9.2']] if v) or None
+
+class Er7View:
+  def __init__(self, er7):
+    self.er7 = er7.lstrip()
+    self.encoding_chars = get_encoding_chars(self.er7)
+    self.segments = {} # Name -> [(start, end)] in message order
+    self.scanner = SEGMENT.finditer(self.er7)
+    self.fields = {} # (start, end) -> split fields, for the segments read so far
+
+  def __getitem__(self, path):
+    return self.get(path)
+
+  def __contains__(self, path):
+    return self.get(path) is not None
+
+  # Value at the path, or default if the message does not have it
+  def get(self, path, default=None):
+    name, occurrence, field, repetition, component, subcomponent = self.__parse_path(path)
+    spans = self.__get_spans(name, occurrence)
+    if len(spans) < occurrence: return default
+
+    value = self.__get_value(spans[occurrence-1], field, repetition, component, subcomponent)
+    return default if value is None or value == '' else value
+
+  # Values of the path in every occurrence of its segment, e.g. the codes of all OBX
+  def get_all(self, path):
+    name, occurrence, field, repetition, component, subcomponent = self.__parse_path(path)
+    values = [self.__get_value(span, field, repetition, component, subcomponent)
+      for span in self.__get_spans(name)[occurrence-1:]]
+    return [v for v in values if v]
+
+  def count(self, name):
+    return len(self.__get_spans(name))
+
+  # Only the requested paths, e.g. as a small output in place of the full JSON
+  def project(self, paths):
+    return {path: self.get(path) for path in paths}
+
+  def get_header(self):
+    return {key: self.get(path) for key, path in HEADER_PATHS.items()}
+
+  # Indexes segments until the requested occurrence is found, or all of them when it is None
+  def __get_spans(self, name, occurrence=None):
+    spans = self.segments.setdefault(name, [])
+    while self.scanner is not None and (occurrence is None or len(spans) < occurrence):
+      match = next(self.scanner, None)
+      if match is None:
+        self.scanner = None
+        break
+      self.segments.setdefault(match.group()[:3], []).append(match.span())
+    return spans
+
+  def __get_value(self, span, field, repetition, component, subcomponent):
+    if field is None: return self.er7[span[0]:span[1]]
+    if span not in self.fields: self.fields[span] = self.__split_fields(span)
+    fields = self.fields[span]
+    if field > len(fields): return None
+
+    text = fields[field-1]
+    if span[0] == 0 and field <= 2: return text # MSH-1 and MSH-2 are never split
+
+    chars = self.encoding_chars
+    for sep, position in [(chars['REPETITION'], repetition), (chars['COMPONENT'], component),
+        (chars['SUBCOMPONENT'], subcomponent)]:
+      if position is None: continue
+      parts = text.split(sep) if sep in text else [text]
+      if position > len(parts): return None
+      text = parts[position-1]
+    return text
+
+  def __split_fields(self, span):
+    segment = self.er7[span[0]:span[1]].rstrip()
+    field_sep = self.encoding_chars['FIELD']
+    # MSH-1 is the field separator itself, so MSH fields are counted from the separator after the name
+    if segment[:3] == 'MSH': return [field_sep] + segment[4:].split(field_sep)
+    return segment[4:].split(field_sep)
+
+  @staticmethod
+  def __parse_path(path):
+    match = PATH.match(path)
+    numbers = [int(n) if n else None for n in match.groups()[1:]] if match else [0]
+    if 0 in numbers: raise KeyError("Invalid path '{}'".format(path)) # Also when it does not match
+
+    occurrence, field, repetition, component, subcomponent = numbers
+    # A component path reads the first repetition, a field path the whole field with its repetitions
+    if repetition is None and component is not None: repetition = 1
+    return match.group(1), occurrence or 1, field, repetition, component, subcomponent
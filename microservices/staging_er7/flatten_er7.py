@@ -0,0 +1,145 @@
+import re
+from datetime import datetime
+
+# Flattens the JSON from parse_er7_lambda into typed rows for analytics:
+#   messages      one row per message with its header, patient and visit
+#   observations  one row per OBX with the message, patient and order (OBR) it belongs to
+# Fields are found by position (e.g. PID_3 then its first component) so the rows are the same whatever the HL7
+# version or datatype names. Column types are the ones the Parquet writer uses for its schemas.
+COLUMNS = {
+  'messages': [
+    ('message_id', 'string'), ('control_id', 'string'), ('event_type', 'string'), ('version', 'string'),
+    ('sending_application', 'string'), ('sending_facility', 'string'), ('message_time', 'timestamp'),
+    ('patient_id', 'string'), ('family_name', 'string'), ('given_name', 'string'), ('birth_date', 'date'),
+    ('gender', 'string'), ('patient_class', 'string'), ('segment_count', 'int32'), ('observation_count', 'int32')
+  ],
+  'observations': [
+    ('message_id', 'string'), ('control_id', 'string'), ('sending_facility', 'string'),
+    ('message_time', 'timestamp'), ('patient_id', 'string'), ('order_id', 'string'), ('order_code', 'string'),
+    ('order_text', 'string'), ('observation_time', 'timestamp'), ('set_id', 'int32'), ('value_type', 'string'),
+    ('observation_code', 'string'), ('observation_text', 'string'), ('coding_system', 'string'),
+    ('sub_id', 'string'), ('value_text', 'string'), ('value_numeric', 'float64'), ('units', 'string'),
+    ('reference_range', 'string'), ('abnormal_flags', 'string'), ('result_status', 'string')
+  ]
+}
+TEXT_VALUE_TYPES = ('FT', 'TX', 'ED', 'RP') # Never read as numbers
+SEGMENT_NAME = re.compile(r'^[A-Z][A-Z0-9]{2}$')
+TS_FORMATS = {4: '%Y', 6: '%Y%m', 8: '%Y%m%d', 10: '%Y%m%d%H', 12: '%Y%m%d%H%M', 14: '%Y%m%d%H%M%S'}
+
+# Returns the rows for each table and the message type (e.g. ORU_R01) to partition them by
+def flatten(hl7_json, message_id):
+  msh = hl7_json.get('MSH', {})
+  message_type = "_".join(v for v in [__get(msh, 'MSH', 9, 1), __get(msh, 'MSH', 9, 2)] if v) or 'UNKNOWN'
+  header = {
+    'message_id': message_id,
+    'control_id': __get(msh, 'MSH', 10),
+    'sending_facility': __get(msh, 'MSH', 4, 1),
+    'message_time': get_timestamp(__get(msh, 'MSH', 7, 1))
+  }
+
+  # Segments in message order, each with the latest patient and order seen before it
+  context = {'PID': {}, 'PV1': {}, 'OBR': {}}
+  observations = []
+  segment_count = 0
+  for name, segment in __iter_segments(hl7_json):
+    segment_count += 1
+    if name in context: context[name] = segment
+    elif name == 'OBX': observations.append(__get_observation(segment, context, header))
+
+  pid, pv1 = context['PID'], context['PV1']
+  message = dict(header,
+    event_type=__get(msh, 'MSH', 9, 2),
+    version=__get(msh, 'MSH', 12, 1),
+    sending_application=__get(msh, 'MSH', 3, 1),
+    patient_id=__get(pid, 'PID', 3, 1),
+    family_name=__get(pid, 'PID', 5, 1),
+    given_name=__get(pid, 'PID', 5, 2),
+    birth_date=__get_date(__get(pid, 'PID', 7, 1)),
+    gender=__get(pid, 'PID', 8),
+    patient_class=__get(pv1, 'PV1', 2),
+    segment_count=segment_count,
+    observation_count=len(observations))
+
+  return message_type, {'messages': [message], 'observations': observations}
+
+def get_timestamp(text):
+  if not text: return None
+  digits = re.split(r'[+\-.]', text, 1)[0] # Ignore fractions of seconds and the offset
+  if len(digits) not in TS_FORMATS or not digits.isdigit(): return None
+  try:
+    return datetime.strptime(digits, TS_FORMATS[len(digits)])
+  except ValueError:
+    return None
+
+def __get_observation(obx, context, header):
+  pid, obr = context['PID'], context['OBR']
+  value_type = __get(obx, 'OBX', 2)
+  value_text = __get(obx, 'OBX', 5)
+
+  return dict(header,
+    patient_id=__get(pid, 'PID', 3, 1),
+    order_id=__get(obr, 'OBR', 3, 1) or __get(obr, 'OBR', 2, 1),
+    order_code=__get(obr, 'OBR', 4, 1),
+    order_text=__get(obr, 'OBR', 4, 2),
+    observation_time=get_timestamp(__get(obx, 'OBX', 14, 1)) or get_timestamp(__get(obr, 'OBR', 7, 1)),
+    set_id=__get_int(__get(obx, 'OBX', 1)),
+    value_type=value_type,
+    observation_code=__get(obx, 'OBX', 3, 1),
+    observation_text=__get(obx, 'OBX', 3, 2),
+    coding_system=__get(obx, 'OBX', 3, 3),
+    sub_id=__get(obx, 'OBX', 4),
+    value_text=value_text,
+    value_numeric=None if value_type in TEXT_VALUE_TYPES else __get_float(value_text),
+    units=__get(obx, 'OBX', 6, 1),
+    reference_range=__get(obx, 'OBX', 7),
+    abnormal_flags=__get(obx, 'OBX', 8),
+    result_status=__get(obx, 'OBX', 11))
+
+# Yields (name, segment) in message order, going through groups whatever their names
+def __iter_segments(node):
+  for name, value in node.items():
+    for child in (value if isinstance(value, list) else [value]):
+      if not isinstance(child, dict): continue
+      if SEGMENT_NAME.match(name): yield name, child
+      else: yield from __iter_segments(child)
+
+# Text of a whole field with all its repetitions, or of one component of its first repetition
+def __get(segment, segment_name, field, component=None):
+  value = segment.get("{}_{}".format(segment_name, field))
+  if component is None: return __get_text(value)
+
+  if isinstance(value, list): value = value[0] if value else None
+  if not isinstance(value, dict): return __get_text(value) if component == 1 else None
+  return __get_text(__get_numbered(value).get(component))
+
+# Components and subcomponents are keyed by datatype and position, e.g. CE_2
+def __get_numbered(value):
+  return {int(key.rsplit('_', 1)[1]): child for key, child in value.items()}
+
+# Joins the parts back as in ER7 so nothing is lost when the value is not a plain string
+def __get_text(value, separators=('^', '&')):
+  if value is None: return None
+  if isinstance(value, str): return value
+  if isinstance(value, list): return "~".join(t for t in (__get_text(v, separators) for v in value) if t is not None)
+
+  parts = __get_numbered(value)
+  if not parts: return None
+  text = separators[0].join(__get_text(parts.get(i), separators[1:] or ('&',)) or ''
+    for i in range(1, max(parts) + 1))
+  return text or None
+
+def __get_date(text):
+  timestamp = get_timestamp(text[:8] if text else text)
+  return timestamp.date() if timestamp else None
+
+def __get_int(text):
+  try:
+    return int(text) if text else None
+  except ValueError:
+    return None
+
+def __get_float(text):
+  try:
+    return float(text.strip()) if text else None
+  except ValueError:
+    return None
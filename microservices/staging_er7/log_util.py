@@ -0,0 +1,46 @@
+import json, logging, os, random
+
+# Logging of message payloads for the Lambda handlers. Payloads carry PHI and their size, so they are only
+# logged for a sample of the messages and, unless log_payload_phi is true, with the content of every
+# segment but MSH replaced by its length:
+#   MSH|^~\&|LAB|...|ORU^R01|123|P|2.5.1\rPID <94 chars>\rOBX <120 chars>
+# JSON payloads only show how many of each top level element they have:
+#   {"MSH":1,"PID":1,"ORDER_OBSERVATION":3} <5234 chars>
+# The rest of the logging passes %-style arguments (logger.debug("Element %s", element)), so nothing is
+# formatted unless its level is enabled.
+level = os.environ.get('log_level', 'INFO').upper()
+# Share of the payloads logged per source, e.g. "0.01" for every handler or "parse=0.1,*=0" per handler
+sample_rates = {}
+for entry in os.environ.get('log_payload_sample', '0').split(','):
+  source, _, rate = entry.rpartition('=')
+  if rate.strip(): sample_rates[source.strip() or '*'] = float(rate)
+show_phi = os.environ.get('log_payload_phi', 'false').lower() == 'true' # Only for test environments
+max_chars = int(os.environ.get('log_payload_max_chars', '2000'))
+
+def is_sampled(source):
+  rate = sample_rates.get(source, sample_rates.get('*', 0))
+  return rate > 0 and (rate >= 1 or random.random() < rate)
+
+# Logs the payload of a sample of the messages, source is the name of the handler logging it
+def log_payload(logger, source, label, payload, level=logging.INFO):
+  if not logger.isEnabledFor(level) or not is_sampled(source): return
+  logger.log(level, "%s (%s): %s", label, source, redact(payload))
+
+# Text of the payload that is safe to log, cut to max_chars
+def redact(payload):
+  if isinstance(payload, (dict, list)):
+    text = json.dumps(payload, separators=(',', ':'))
+    if not show_phi: text = "{} <{} chars>".format(json.dumps(__get_counts(payload), separators=(',', ':')), len(text))
+  else:
+    text = str(payload) if show_phi else __redact_er7(str(payload))
+  return text if len(text) <= max_chars else "{}... <{} chars>".format(text[:max_chars], len(text))
+
+def __redact_er7(er7):
+  segments = er7.replace('\r\n', '\r').replace('\n', '\r').split('\r')
+  # MSH identifies the message without describing the patient, the other segments only show their name
+  return "\\r".join(s if s.startswith('MSH') else "{} <{} chars>".format(s[:3], len(s)) for s in segments if s)
+
+# Occurrences of each top level element, values are left out
+def __get_counts(data):
+  if isinstance(data, list): return len(data)
+  return {k: len(v) if isinstance(v, list) else 1 for k, v in data.items()}
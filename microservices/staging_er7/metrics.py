@@ -0,0 +1,77 @@
+import json, os, sys, threading, time
+from contextlib import contextmanager
+
+# Metrics of an invocation, printed in CloudWatch embedded metric format (EMF) when it ends:
+#   with metrics.timed('dedup_query', source=owner): ...    milliseconds, and dedup_query_errors if it raises
+#   metrics.add('message_bytes', len(data), 'Bytes', source=owner, message_type='ORU_R01')
+#   metrics.count('duplicate', source=owner)
+#   metrics.flush()                                          done by @startup.handler after each invocation
+# Values are grouped by their dimensions, each group is one record that CloudWatch turns into metrics per
+# function and per function with the given dimensions. Dimensions that are None are left out.
+# Outside Lambda (benchmarks, scripts) nothing is recorded unless enabled is set.
+NAMESPACE = 'HCDL/Ingest'
+MAX_VALUES = 100 # Most values EMF accepts for one metric in a record
+function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+enabled = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+pending = {} # Dimensions -> {metric name: (unit, [values])}
+lock = threading.Lock() # Stages of different messages run in parallel threads
+
+# Lambda sends stdout to CloudWatch, written at once so records from other threads do not interleave.
+# Offline runs can set enabled and replace it to collect the records.
+def emit(line):
+  sys.stdout.write(line + "\n")
+
+def add(name, value, unit='None', **dimensions):
+  if not enabled: return
+  key = tuple(sorted((k, str(v)) for k, v in dimensions.items() if v is not None))
+  with lock:
+    pending.setdefault(key, {}).setdefault(name, (unit, []))[1].append(value)
+
+def count(name, value=1, **dimensions):
+  add(name, value, 'Count', **dimensions)
+
+@contextmanager
+def timed(stage, **dimensions):
+  start = time.perf_counter()
+  try:
+    yield
+  except Exception:
+    count(stage + '_errors', **dimensions)
+    raise
+  finally:
+    add(stage, round((time.perf_counter() - start)*1000, 2), 'Milliseconds', **dimensions)
+
+# Emits and returns the records of everything added since the last flush
+def flush(namespace=NAMESPACE):
+  with lock:
+    groups = dict(pending)
+    pending.clear()
+
+  records = []
+  for dimensions, values in groups.items():
+    longest = max(len(v) for unit, v in values.values())
+    for start in range(0, longest, MAX_VALUES):
+      chunk = {name: (unit, v[start:start+MAX_VALUES]) for name, (unit, v) in values.items() if len(v) > start}
+      records.append(get_record(namespace, dict(dimensions), chunk))
+
+  for record in records: emit(json.dumps(record))
+  return records
+
+# A record for values given as metric name -> (unit, value or list of values)
+def get_record(namespace, dimensions, values):
+  dimensions = dict(dimensions, function=function_name)
+  dimension_sets = [['function']] + ([sorted(dimensions)] if len(dimensions) > 1 else [])
+  record = {
+    '_aws': {
+      'Timestamp': int(time.time()*1000),
+      'CloudWatchMetrics': [{
+        'Namespace': namespace,
+        'Dimensions': dimension_sets,
+        'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, value) in values.items()]
+      }]
+    }
+  }
+  record.update(dimensions)
+  for name, (unit, value) in values.items():
+    record[name] = value[0] if isinstance(value, list) and len(value) == 1 else value
+  return record
@@ -0,0 +1,128 @@
+import json, os, re, threading
+from collections import Counter
+import er7_view
+
+# Fixes applied to ER7 messages before parsing, with a rule set per sending application (MSH-3) configured in
+# normalize_rules.json ("*" for the senders without their own):
+#   {"*": ["line_endings"],
+#    "ATHENANET": ["line_endings", "blank_segments", {"drop_segments": ["ZPD"]},
+#      {"name": "stray_escape", "pattern": "\\\\(?![^\\r\\n])", "replace": "", "first": "\\"}]}
+# A rule set is compiled into one regular expression with a branch per rule, so a message is rewritten in a single
+# pass however many rules it has, and returned as it is when no rule fires. Compiled sets are kept for the warm
+# invocations. Custom patterns see the whole message, (?<![^\r\n]) and (?![^\r\n]) match the start and end of a
+# segment, and their replacement is literal text. They are tried before the named rules, in PRECEDENCE order.
+# "first" lists the characters a custom pattern can start with, without it the set cannot skip ahead to the
+# places where a rule may match and is several times slower.
+BREAK = r'(?:\r\n|\r|\n)'
+START = r'(?<![^\r\n])' # At the start of the message or after a break
+END = r'(?![^\r\n])'
+rules_file = os.environ.get('normalize_rules', os.path.join(os.path.dirname(os.path.realpath(__file__)),
+  'normalize_rules.json'))
+
+# Named rules, each a function of the field separator giving the characters it starts with, its pattern and
+# its replacement
+NAMED_RULES = {
+  # Lines with nothing but whitespace, e.g. between the messages of a file
+  'blank_segments': lambda sep: (' \t\r\n', START + r'(?:[ \t]*' + BREAK + r')+', ''),
+  # Empty fields at the end of a segment, HL7 lets senders leave them out
+  'trailing_separators': lambda sep: (sep, r'(?:' + re.escape(sep) + r'[ \t]*)+' + END, ''),
+  'trailing_whitespace': lambda sep: (' \t', r'[ \t]+' + END, ''),
+  'leading_whitespace': lambda sep: (' \t', START + r'[ \t]+', ''),
+  # HL7 separates segments with \r, lone \r are already right
+  'line_endings': lambda sep: ('\r\n', r'\r\n|\n', '\r')
+}
+PRECEDENCE = list(NAMED_RULES) # Longer matches first, e.g. blank lines before the breaks they are made of
+compiled = {} # (sender, field separator) -> RuleSet
+lock = threading.Lock() # The trigger prepares messages in several threads
+
+# Rules, given as (name, first characters, pattern, replacement), compiled into one pattern with a named group each
+class RuleSet:
+  def __init__(self, rules):
+    self.names = [name for name, first, pattern, replacement in rules]
+    self.pattern = None
+    self.groups = {} # Group number -> (rule, replacement)
+    self.line_endings_only = self.names == ['line_endings']
+    if not rules: return
+
+    branches = "|".join("(?P<r{}>{})".format(i, rule[2]) for i, rule in enumerate(rules))
+    # A lookahead on the first characters lets the regex engine skip to the places where a rule may match, which
+    # it cannot do by itself past several branches or a lookbehind
+    if all(rule[1] for rule in rules) and (len(rules) > 1 or rules[0][2].startswith('(?')):
+      chars = sorted(set("".join(rule[1] for rule in rules)))
+      branches = "(?=[{}])(?:{})".format("".join(re.escape(c) for c in chars), branches)
+    self.pattern = re.compile(branches)
+    # A rule's group encloses any group of its pattern, so it is the last one matched
+    self.groups = {self.pattern.groupindex['r{}'.format(i)]: (i, rule[3]) for i, rule in enumerate(rules)}
+
+  # The message with the rules applied and how many times each rule fired
+  def apply(self, er7):
+    if self.pattern is None: return er7, Counter()
+    if self.line_endings_only:
+      # The default rule set, str.replace does it several times faster than the regex
+      count = er7.count('\n')
+      if count: er7 = er7.replace('\r\n', '\r').replace('\n', '\r')
+      return er7, Counter({'line_endings': count} if count else {})
+
+    counts = [0] * len(self.names)
+    groups = self.groups
+
+    def replace(match):
+      i, replacement = groups[match.lastindex]
+      counts[i] += 1
+      return replacement
+    er7 = self.pattern.sub(replace, er7)
+    return er7, Counter({name: count for name, count in zip(self.names, counts) if count})
+
+def load_rule_sets(path=rules_file):
+  if not os.path.exists(path): return {'*': ['line_endings']}
+  with open(path) as f: return json.load(f)
+
+rule_sets = load_rule_sets()
+
+# Normalizes the message with the rules of its sender, returns the message and the rules that fired
+def normalize(er7):
+  sender, field_sep = __get_sender(er7)
+  return get_rule_set(sender, field_sep).apply(er7)
+
+def get_rule_set(sender, field_sep='|'):
+  key = (sender if sender in rule_sets else '*', field_sep)
+  if key not in compiled:
+    with lock:
+      if key not in compiled: compiled[key] = compile_rules(rule_sets.get(key[0], []), field_sep)
+  return compiled[key]
+
+# Rules are given by name, as {"drop_segments": [segment names]} or as {"name", "pattern", "replace"}
+def compile_rules(specs, field_sep='|'):
+  sep = re.escape(field_sep)
+  custom, named = [], set()
+
+  for spec in specs:
+    if isinstance(spec, str):
+      if spec not in NAMED_RULES: raise ValueError("Unknown normalization rule '{}'".format(spec))
+      named.add(spec)
+    elif 'drop_segments' in spec:
+      segments = "|".join(re.escape(s) for s in spec['drop_segments'])
+      pattern = START + r'(?:' + segments + r')(?![^' + sep + r'\r\n])[^\r\n]*' + BREAK + '?'
+      custom.append((spec.get('name', 'drop_segments'), "".join(s[:1] for s in spec['drop_segments']), pattern, ''))
+    else:
+      try:
+        re.compile(spec['pattern'])
+      except re.error as e:
+        raise ValueError("Invalid pattern of normalization rule '{}': {}".format(spec.get('name'), e))
+      custom.append((spec['name'], spec.get('first'), spec['pattern'], spec.get('replace', '')))
+
+  return RuleSet(custom + [(name,) + NAMED_RULES[name](field_sep) for name in PRECEDENCE if name in named])
+
+# Sending application (MSH-3.1) and field separator, the default rules are used for what is not valid ER7
+def __get_sender(er7):
+  er7 = er7.lstrip()
+  try:
+    chars = er7_view.get_encoding_chars(er7)
+  except ValueError:
+    return None, '|'
+
+  # MSH-3 follows the encoding characters, read in place as the view would split the whole segment
+  start = er7.find(chars['FIELD'], 4) + 1
+  end = min(i for i in [er7.find(c, start) for c in (chars['FIELD'], chars['COMPONENT'], '\r', '\n')] + [len(er7)]
+    if i != -1)
+  return er7[start:end] or None, chars['FIELD']
@@ -0,0 +1,75 @@
+import hashlib, io, logging, os, re
+from datetime import datetime, timezone
+import startup
+with startup.timed('import:pyarrow'):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+import flatten_er7
+
+logger = logging.getLogger()
+
+# Buffers rows per table and partition, then writes each buffer as one compressed Parquet file under
+#   protocol=hl7v2/format=parquet/zone=staged/table=<table>/message_type=<type>/ingest_date=<yyyy-mm-dd>/
+# The target is an S3 URL (s3://bucket/prefix) or a local folder, so the writer can run without AWS. A file is named
+# after the messages in it, so writing the same rows again, e.g. when a batch is retried, replaces the file.
+target = os.environ.get('staged_target', 's3://' + os.environ.get('bucket_name', ''))
+compression = os.environ.get('staged_compression', 'snappy')
+max_rows = int(os.environ.get('staged_max_rows', '100000')) # Flush on its own once this many rows are buffered
+ZONE_PREFIX = "protocol=hl7v2/format=parquet/zone=staged"
+NOT_KEY_SAFE = re.compile(r'[^A-Za-z0-9_-]') # Message types come from MSH-9, e.g. a '/' would add a folder
+TYPES = {'string': pa.string(), 'int32': pa.int32(), 'float64': pa.float64(), 'timestamp': pa.timestamp('ms'),
+  'date': pa.date32()}
+SCHEMAS = {table: pa.schema([(name, TYPES[t]) for name, t in columns]) for table, columns in flatten_er7.COLUMNS.items()}
+
+buffers = {} # (table, message type, ingest date) -> rows
+s3 = startup.client('s3') # Only created when writing to S3
+
+def add_rows(message_type, tables, ingest_date=None):
+  ingest_date = ingest_date or datetime.now(timezone.utc).strftime('%Y-%m-%d')
+  message_type = NOT_KEY_SAFE.sub('_', message_type)
+  for table, rows in tables.items():
+    if rows: buffers.setdefault((table, message_type, ingest_date), []).extend(rows)
+
+  if buffered_rows() >= max_rows: return flush()
+  return []
+
+def buffered_rows():
+  return sum(len(rows) for rows in buffers.values())
+
+# Ids of the messages with rows still buffered
+def buffered_message_ids():
+  return {row['message_id'] for rows in buffers.values() for row in rows}
+
+# Writes every buffer and returns the locations written, buffers that fail to write are kept
+def flush():
+  locations = []
+  for partition in list(buffers):
+    table, message_type, ingest_date = partition
+    rows = buffers[partition]
+    message_ids = "\n".join(dict.fromkeys(row['message_id'] for row in rows))
+    key = "{}/table={}/message_type={}/ingest_date={}/part-{}.parquet".format(
+      ZONE_PREFIX, table, message_type, ingest_date, hashlib.sha256(message_ids.encode()).hexdigest()[:32])
+
+    try:
+      data = io.BytesIO()
+      pq.write_table(pa.Table.from_pylist(rows, schema=SCHEMAS[table]), data, compression=compression)
+      locations.append(__write(key, data.getvalue()))
+    except Exception as e:
+      logger.error("Unable to write {} {} row(s) to '{}': {}".format(len(rows), table, key, e))
+      continue
+    logger.info("Wrote {} {} row(s) to '{}'".format(len(rows), table, locations[-1]))
+    del buffers[partition]
+
+  return locations
+
+def __write(key, data):
+  if target.startswith('s3://'):
+    bucket, _, prefix = target[5:].partition('/')
+    key = prefix.rstrip('/') + '/' + key if prefix else key
+    s3.put_object(Bucket=bucket, Key=key, Body=data, ContentType='application/vnd.apache.parquet')
+    return "s3://{}/{}".format(bucket, key)
+
+  path = os.path.join(target, key)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as f: f.write(data)
+  return path
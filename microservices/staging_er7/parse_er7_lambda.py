@@ -1,27 +1,58 @@
-import json, logging
-import hl7apy
-from hl7apy import parser
+import logging, os
+import startup, log_util, metrics
+import er7_tokenizer, er7_view, structure_index
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(log_util.level)
 
+# 'native' uses our single pass tokenizer, 'hl7apy' builds the full hl7apy object tree
+parse_engine = os.environ.get('parse_engine', 'hl7apy')
+# Structure validation is only available through hl7apy
+validate_structure = os.environ.get('validate_structure', 'false').lower() == 'true'
+# Comma separated paths (e.g. MSH.9.1,PID.3.1) to output in place of the JSON tree, empty for the full conversion
+parse_fields = [f.strip() for f in os.environ.get('parse_fields', '').split(',') if f.strip()]
+
+# Looks up the structure of hl7apy elements in a precompiled index rather than the hl7apy object tree. It has not
+# been faster than hl7apy's own lookups so far, so it is opt-in.
+use_structure_index = os.environ.get('structure_index', 'false').lower() == 'true'
+
+# hl7apy takes a while to import, it is only loaded during init when it parses the messages
+uses_hl7apy = validate_structure or (parse_engine != 'native' and not parse_fields)
+if uses_hl7apy: startup.import_module('hl7apy.parser')
+ST = None # hl7apy's string type, looked up with the first message converted rather than for each element
+
+@startup.handler
 def lambda_handler(er7, lambda_context):
-  logger.info(er7)
-  er7_obj = parser.parse_message(er7)
-  logger.info(er7_obj)
-  
-  hl7_json = __parse_er7_object_to_json(er7_obj)
-  logger.info(json.dumps(hl7_json))
+  log_util.log_payload(logger, 'parse', "Parsing message", er7)
+  message_type = er7_view.get_message_type(er7)
+
+  with metrics.timed('parse', message_type=message_type):
+    if parse_fields and not validate_structure:
+      hl7_json = er7_view.Er7View(er7).project(parse_fields)
+    elif parse_engine == 'native' and not validate_structure:
+      hl7_json = er7_tokenizer.to_json(er7)
+    else:
+      er7_obj = startup.import_module('hl7apy.parser').parse_message(er7, force_validation=validate_structure)
+      logger.debug("hl7apy message: %s", er7_obj)
+      index = structure_index.load_index(er7_obj.version) if use_structure_index else None
+      hl7_json = __parse_er7_object_to_json(er7_obj, index)
+  metrics.count('parsed', message_type=message_type)
+
+  log_util.log_payload(logger, 'parse', "Parsed message", hl7_json)
   
   return hl7_json
 
-def __parse_er7_object_to_json(er7_obj):
+# Without an index every element's structure is looked up through the hl7apy object tree
+def __parse_er7_object_to_json(er7_obj, index=None):
+  global ST
+  if ST is None: ST = startup.import_module('hl7apy.base_datatypes').ST
   json_msg = {}
+  structure = ({}, None) if index is None else (index['groups'].get(er7_obj.name, {}), 'group')
   
   try:
     for c in er7_obj.children:
-      __add_child_element(json_msg, c)
-  except KeyError as e:
+      __add_child_element(json_msg, c, structure, index)
+  except KeyError:
     errMsg = "Unable to determine structure, message not written"
     logger.error(errMsg)
     raise
@@ -29,8 +60,8 @@ def __parse_er7_object_to_json(er7_obj):
   return json_msg
 
 # Recursively builds our data structure
-def __add_child_element(parent_data, child_element):
-  logger.debug("Working on element: " +str(child_element))
+def __add_child_element(parent_data, child_element, structure, index):
+  logger.debug("Working on element: %s", child_element)
 
   # Throw exception if this element does not exist in the version being parsed
   if child_element.name is None:
@@ -40,12 +71,20 @@ def __add_child_element(parent_data, child_element):
   # Use the short name
   c_name = child_element.name
 
+  # Find the element in its parent's structure, asking the element itself only if it isn't indexed
+  children, kind = structure
+  info = children.get(c_name)
+  if info is None:
+    is_leaf = child_element.reference[0] == "leaf"
+  else:
+    is_leaf = kind != 'group' and info[0] # Segments and groups are never leaves
+
   # Add element name (key) and value directly if it's a leaf type and then return
-  if child_element.reference[0] == "leaf":
-    logger.debug(type(child_element.value)) 
+  if is_leaf:
+    logger.debug("Value type: %s", type(child_element.value))
     if isinstance(child_element.value, str):
       parent_data[c_name] = child_element.value
-    elif isinstance(child_element.value, hl7apy.base_datatypes.ST):
+    elif isinstance(child_element.value, ST):
       # Needed because a value of two double quotes ("") seems to throw things off
       parent_data[c_name] = child_element.value.value
     return
@@ -53,8 +92,19 @@ def __add_child_element(parent_data, child_element):
   # Since it is not a key-value leaf, it's going to be a dictionary
   c_data = {}
   
+  if info is None:
+    max_repetitions = child_element.parent.repetitions[child_element.name][1]
+    child_structure = ({}, None)
+  elif kind == 'group':
+    max_repetitions = info[0]
+    child_structure = (index['groups'].get(c_name, {}), 'group') if info[1] == 'GRP' \
+      else (index['segments'].get(c_name, {}), 'segment')
+  else:
+    max_repetitions = info[1]
+    child_structure = (index['datatypes'].get(info[2], {}), 'datatype')
+
   # Check the max occurances: if it's unique then the child dictionary can be added directly
-  if child_element.parent.repetitions[child_element.name][1] == 1:
+  if max_repetitions == 1:
     parent_data[c_name] = c_data
 
   # If it can repeat then the child needs to be in a list
@@ -66,4 +116,6 @@ def __add_child_element(parent_data, child_element):
 
   # Add the next generation
   for gc in child_element.children: 
-    __add_child_element(c_data, gc)
\ No newline at end of file
+    __add_child_element(c_data, gc, child_structure, index)
+
+startup.ready()
@@ -1,14 +1,21 @@
 import logging
+import startup, log_util, metrics
+import er7_view, normalize
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(log_util.level)
 
+@startup.handler
 def lambda_handler(er7, lambda_context):
-  logger.info(er7)
+  log_util.log_payload(logger, 'prepare', "Preparing message", er7)
 
-  # The most common issues, add more complicated rules if required
-  er7 = er7.replace('\r\n','\r')
-  er7 = er7.replace('\n','\r')
-  er7 = er7.replace('\r','\r')
+  # One pass with the rules of the sender, see normalize_rules.json
+  with metrics.timed('prepare'):
+    er7, fired = normalize.normalize(er7)
+  for rule, count in fired.items(): metrics.count('rule_fired', count, rule=rule)
+  if fired: logger.debug("Normalization rules fired: %s", dict(fired))
+  metrics.add('message_bytes', len(er7.encode()), 'Bytes', message_type=er7_view.get_message_type(er7))
   
-  return (er7)
\ No newline at end of file
+  return (er7)
+
+startup.ready()
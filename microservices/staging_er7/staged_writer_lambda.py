@@ -0,0 +1,41 @@
+import json, logging
+import startup, log_util
+import flatten_er7, parquet_writer
+
+logger = logging.getLogger()
+logger.setLevel(log_util.level)
+
+# Writes staged messages to the data lake as Parquet. Records come from an SQS queue subscribed to the topic,
+# which lets Lambda hand over many messages at once so each flush writes few, larger files.
+@startup.handler
+def lambda_handler(event, lambda_context):
+  skipped = 0
+  locations = []
+  for record in event['Records']:
+    message_id, message = __get_message(record)
+    try:
+      message_type, tables = flatten_er7.flatten(json.loads(message), message_id)
+    except (ValueError, AttributeError, TypeError) as e:
+      # Retrying would not help, the message is still in the data lake as JSON
+      logger.warning("Unable to flatten message '{}': {}".format(message_id, e))
+      skipped += 1
+      continue
+    locations += parquet_writer.add_rows(message_type, tables)
+
+  # Nothing stays buffered between invocations, a frozen or recycled container would lose it.
+  # Only the messages with rows that could not be written go back to the queue.
+  locations += parquet_writer.flush()
+  failed_ids = parquet_writer.buffered_message_ids()
+  parquet_writer.buffers.clear() # The retried messages bring these rows again
+  logger.info("Flattened {} message(s) into {} file(s), skipped {}".format(
+    len(event['Records']) - skipped, len(locations), skipped))
+  if failed_ids: logger.error("Unable to write the rows of {} message(s)".format(len(failed_ids)))
+
+  return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_ids)]}
+
+# Accepts SQS records with raw message delivery as well as SNS records
+def __get_message(record):
+  if 'Sns' in record: return record['Sns']['MessageId'], record['Sns']['Message']
+  return record['messageId'], record['body']
+
+startup.ready()
@@ -0,0 +1,25 @@
+import json, logging
+import log_util
+import prepare_er7_lambda, parse_er7_lambda
+
+logger = logging.getLogger()
+logger.setLevel(log_util.level)
+
+# Runs the staging steps in-process, in the same order as the state machine in staging_stack.yml.
+# Each stage takes the previous result and a Lambda context, like the Lambda handlers themselves.
+STAGES = [prepare_er7_lambda.lambda_handler, parse_er7_lambda.lambda_handler]
+
+# Returns a response shaped like a synchronous Step Function execution
+def run(message, stages=STAGES, lambda_context=None):
+  execution_input = json.dumps({'Message': message})
+  data = message
+
+  try:
+    for stage in stages:
+      data = stage(data, lambda_context)
+  except Exception as e:
+    logger.warning("Staging pipeline failed: {}".format(type(e).__name__))
+    return {'status': 'FAILED', 'input': execution_input, 'error': type(e).__name__, 'cause': str(e)}
+
+  # Step Functions gives back the output as compact JSON
+  return {'status': 'SUCCEEDED', 'input': execution_input, 'output': json.dumps(data, separators=(',', ':'))}
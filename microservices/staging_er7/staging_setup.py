@@ -1,31 +1,84 @@
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from lib import lambda_util, cf_util
-import os
+from microservices.staging_er7 import structure_index
+import os, re, shutil, sys
 
 local_folder = os.path.dirname(os.path.realpath(__file__))
 template_file_path = local_folder + "/staging_stack.yml"
 hl7apyUrl="https://files.pythonhosted.org/packages/6d/97/9903a942be1d3d7a193d643ef29c73ad300ab8594e01e6f8d23285bcf77a/hl7apy-1.3.3.tar.gz"
+structureIndexSuffix="-index1" # Change when the structure index format changes to publish a new layer
 
-def deploy(stack_name, core_stack_name, wait=False):
+def deploy(stack_name, core_stack_name, wait=False, parse_engine='hl7apy', staging_mode='step_function',
+    parquet_layer_arn='', parse_fields='', hl7_versions='', structure_index=False):
   params = {
-    'CoreStack':core_stack_name
+    'CoreStack':core_stack_name,
+    'ParseEngine':parse_engine,
+    'StagingMode':staging_mode,
+    'ParquetLayerArn':parquet_layer_arn,
+    'ParseFields':parse_fields,
+    'StructureIndex':str(structure_index).lower()
   }
   artifact_bucket = cf_util.get_physical_resource_id(core_stack_name, "ArtifactBucket")
   
-  # Sync our Lambda functions
-  params.update(__sync_and_get_params("trigger_lambda.py", artifact_bucket, 'Trigger'))
-  params.update(__sync_and_get_params("prepare_er7_lambda.py", artifact_bucket, 'Prepare'))
-  params.update(__sync_and_get_params("parse_er7_lambda.py", artifact_bucket, 'Parse'))
-
-  # Deploy the Lambda Layer 
-  layer_key = lambda_util.upload_external_library_for_lambda_layer(hl7apyUrl, artifact_bucket, 'python')
-  params.update({'Hl7ParsingLibKey':layer_key})
+  # Sync our Lambda functions and the Lambda Layer at the same time
+  common_modules = ["startup.py", "log_util.py", "metrics.py"] # Used by every handler
+  parse_modules = ["er7_tokenizer.py", "er7_view.py", "structure_index.py"] + common_modules
+  prepare_modules = ["er7_view.py", "normalize.py", "normalize_rules.json"] + common_modules
+  # The trigger carries the staging steps too so it can run them in-process
+  trigger_modules = ["staging_pipeline.py", "prepare_er7_lambda.py", "parse_er7_lambda.py", "er7_batch.py"] + \
+    sorted(set(parse_modules + prepare_modules))
+  functions = [ # File, parameter prefix, modules
+    ("trigger_lambda.py", 'Trigger', trigger_modules),
+    ("prepare_er7_lambda.py", 'Prepare', prepare_modules),
+    ("parse_er7_lambda.py", 'Parse', parse_modules),
+    ("staged_writer_lambda.py", 'StagedWriter', ["flatten_er7.py", "parquet_writer.py"] + common_modules)
+  ]
+  with ThreadPoolExecutor() as executor:
+    versions = __get_hl7_versions(hl7_versions)
+    layer = executor.submit(lambda_util.upload_python_layer, hl7apyUrl, artifact_bucket, ['hl7apy'], 'python3.9',
+      lambda layer_folder: __prepare_layer(layer_folder, versions),
+      structureIndexSuffix + ("-" + ",".join(versions) if versions else ""), "import hl7apy.core, hl7apy.parser")
+    synced = lambda_util.sync_lambda_functions([(local_folder+"/"+file_name, [local_folder+"/"+f for f in modules])
+      for file_name, prefix, modules in functions], artifact_bucket)
+    for (file_name, prefix, modules), (key, version) in zip(functions, synced):
+      params.update(__get_function_params(file_name, prefix, key, version))
+    params.update({'Hl7ParsingLibKey':layer.result()})
   
   return cf_util.create_or_update_stack(stack_name, template_file_path, params,['CAPABILITY_IAM'], wait)
   
-def __sync_and_get_params(file_name, artifact_bucket, prefix):
-  key, version = lambda_util.sync_lambda_function(local_folder+"/"+file_name, artifact_bucket)
+# Comma separated HL7 versions (e.g. 2.3,2.5.1) to keep in the layer, all of them when empty
+def __get_hl7_versions(hl7_versions):
+  versions = {v.strip() for v in hl7_versions.split(',') if v.strip()}
+  if versions: versions.add(structure_index.DEFAULT_VERSION) # Used for messages without MSH-12
+  return sorted(versions)
+
+def __prepare_layer(layer_folder, versions):
+  if versions: __trim_hl7_versions(layer_folder, versions)
+  __add_structure_index(layer_folder)
+
+# Remove the structure definitions of the versions we do not receive, hl7apy only lists the versions it finds
+def __trim_hl7_versions(layer_folder, versions):
+  library_folder = os.path.join(layer_folder, 'hl7apy')
+  available = {name[1:].replace('_', '.'): name for name in os.listdir(library_folder) if re.match(r'^v2(_\d+)+$', name)}
+  missing = [v for v in versions if v not in available]
+  if missing: raise ValueError("HL7 versions {} are not supported by hl7apy".format(missing))
+
+  for version, name in available.items():
+    if version not in versions: shutil.rmtree(os.path.join(library_folder, name))
+  print("Kept HL7 versions {} in the layer".format(versions))
+
+# Precompile the HL7 structure index with the downloaded library and ship it in the layer
+def __add_structure_index(layer_folder):
+  sys.path.insert(0, layer_folder)
+  try:
+    folder = structure_index.write_index_files(layer_folder)
+    print("Added HL7 structure index to the layer in '{}'".format(folder))
+  finally:
+    sys.path.remove(layer_folder)
+
+def __get_function_params(file_name, prefix, key, version):
   handler = file_name.replace('.py',".lambda_handler")
   
   return {"{}LambdaKey".format(prefix):key, '{}LambdaVersion'.format(prefix): version, '{}Handler'.format(prefix): handler}
\ No newline at end of file
@@ -0,0 +1,108 @@
+import importlib, json, os, sys, threading, time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import metrics
+
+# Cold start bookkeeping shared by the Lambda handlers:
+#   sns = startup.client('sns')           created on first use and reused by warm invocations
+#   startup.preload(sns)                  created during init, for what every invocation needs
+#   with startup.timed('import:pyarrow'): import pyarrow
+#   @startup.handler                      emits the timings and the metrics of each invocation
+#   startup.ready()                       at the end of the handler module, records the init time
+#   startup.get_executor().submit(...)    threads for independent calls, kept between invocations
+# Import this module before the others so the init time covers them.
+NAMESPACE = 'HCDL/Startup'
+started = time.perf_counter()
+timings = {} # Metric name -> milliseconds, not emitted yet
+instances = {} # (kind, name) -> client, resource or table
+lock = threading.RLock() # Clients are created once, even when threads ask for them at the same time
+cold_start = True
+io_workers = int(os.environ.get('io_workers', '8')) # Threads of the shared executor
+# Connections each client keeps open for reuse, enough for the shared executor and the handlers' own threads
+max_pool_connections = int(os.environ.get('max_pool_connections', '50'))
+executor = None
+
+# Stands in for a client until it is first used, so modules can keep their clients as globals
+class Lazy:
+  def __init__(self, kind, name, create, metric=None):
+    self.kind, self.name, self.create = kind, name, create
+    self.metric = metric or "{}:{}".format(kind, name)
+
+  def __getattr__(self, attr):
+    return getattr(self.get(), attr)
+
+  def get(self):
+    key = (self.kind, self.name)
+    if key not in instances:
+      with lock:
+        if key not in instances:
+          with timed(self.metric): instances[key] = self.create()
+    return instances[key]
+
+def client(service):
+  return Lazy('client', service, lambda: import_module('boto3').client(service, config=__get_config()))
+
+def resource(service):
+  return Lazy('resource', service, lambda: import_module('boto3').resource(service, config=__get_config()))
+
+def table(name):
+  return Lazy('table', name, lambda: resource('dynamodb').get().Table(name), 'table') # Same metric for every stack
+
+def preload(*lazies):
+  for lazy in lazies: lazy.get()
+
+def get_executor():
+  global executor
+  if executor is None:
+    with lock:
+      if executor is None: executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='io')
+  return executor
+
+# Modules imported here the first time are timed, e.g. optional dependencies only some invocations need
+def import_module(name):
+  if name in sys.modules: return sys.modules[name]
+  with timed("import:{}".format(name)): return importlib.import_module(name)
+
+@contextmanager
+def timed(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    with lock: timings[name] = round((time.perf_counter() - start)*1000, 1)
+
+def ready():
+  with lock: timings['init'] = round((time.perf_counter() - started)*1000, 1) # The outermost module is last
+
+# Emits the metrics of the invocation and what was timed since the last one, only for the function Lambda
+# invokes (the staging handlers also run inside the trigger). Outside Lambda the handlers run as they are, so
+# benchmarks do not time or print the records. Startup timings are not emitted on warm invocations that created
+# nothing new.
+def handler(function):
+  if os.environ.get('_HANDLER') != "{}.{}".format(function.__module__, function.__name__): return function
+
+  @wraps(function)
+  def wrapper(event, context):
+    try:
+      return function(event, context)
+    finally:
+      __emit()
+      metrics.flush()
+  return wrapper
+
+def __get_config():
+  config = import_module('botocore.config')
+  return config.Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+
+def __emit():
+  global cold_start
+  with lock:
+    values = dict(timings)
+    timings.clear()
+    if cold_start: values['cold_start'] = 1
+    cold_start = False
+  if not values: return
+
+  values = {name: ('Count' if name == 'cold_start' else 'Milliseconds', v) for name, v in values.items()}
+  metrics.emit(json.dumps(metrics.get_record(NAMESPACE, {}, values)))
@@ -0,0 +1,82 @@
+import json, logging, os, re
+
+logger = logging.getLogger()
+
+# Precompiled HL7 structure definitions, one JSON file per version. Each structure maps its children to
+#   groups (messages and groups):  child -> [max repetitions, 'SEG' or 'GRP'] in definition order
+#   segments and datatypes:        child -> [is leaf, max repetitions, datatype]
+# with fields and components also indexed on their own for elements found outside their parent.
+INDEX_FOLDER = 'hl7_structure_index'
+DEFAULT_VERSION = '2.5' # Same default as hl7apy when MSH-12 is missing
+index_path = os.environ.get('structure_index_path', '/opt/python/' + INDEX_FOLDER)
+indexes = {} # Memoized per version, reused between calls
+
+def load_index(version):
+  if version not in indexes:
+    file_path = os.path.join(index_path, "{}.json".format(version))
+
+    if re.match(r'^[0-9.]+$', version) and os.path.exists(file_path):
+      with open(file_path) as f: indexes[version] = json.load(f)
+    else:
+      logger.warning("No precompiled structure index for version '{}', building it".format(version))
+      indexes[version] = build_index(version)
+
+  return indexes[version]
+
+def build_index(version):
+  # Only needed when building the index, so hl7apy is not loaded otherwise
+  import hl7apy
+  from hl7apy import base_datatypes
+  lib = hl7apy.load_library(version)
+
+  index = {
+    'version': version,
+    # The JSON conversion only keeps subcomponents whose value is an hl7apy ST instance
+    'keeps_st': issubclass(lib.get_base_datatypes()['ST'], base_datatypes.ST),
+    'messages': sorted(lib.MESSAGES),
+    'groups': {},
+    'segments': {},
+    'datatypes': {},
+    'fields': {name: __get_element(ref) for name, ref in lib.FIELDS.items()},
+    'components': {name: __get_element(ref) for name, ref in lib.DATATYPES.items()}
+  }
+
+  for name, ref in list(lib.MESSAGES.items()) + list(lib.GROUPS.items()):
+    index['groups'][name] = __get_group_children(ref)
+  for name, ref in lib.SEGMENTS.items():
+    # A few definitions are malformed or empty (e.g. ORO in 2.1), hl7apy treats them as having no children
+    index['segments'][name] = __get_children(ref[1] if ref[0] in ('sequence', 'choice') and len(ref) > 1 else ())
+  for name, children in lib.DATATYPES_STRUCTS.items():
+    index['datatypes'][name] = __get_children(children)
+
+  return index
+
+def write_index_files(target_folder):
+  import hl7apy
+  folder = os.path.join(target_folder, INDEX_FOLDER)
+  os.makedirs(folder, exist_ok=True)
+
+  for version in sorted(hl7apy.SUPPORTED_LIBRARIES):
+    with open(os.path.join(folder, "{}.json".format(version)), 'w') as f:
+      json.dump(build_index(version), f, separators=(',', ':'))
+
+  return folder
+
+def __get_group_children(ref):
+  children = {}
+  for name, child_ref, cardinality, kind in ref[1]:
+    # First definition wins, hl7apy renames later duplicates (e.g. ROL_1)
+    if name not in children: children[name] = [cardinality[1], kind]
+  return children
+
+def __get_children(children_refs):
+  children = {}
+  for name, child_ref, cardinality, kind in children_refs:
+    if name not in children:
+      is_leaf, datatype = __get_element(child_ref)
+      children[name] = [is_leaf, cardinality[1], datatype]
+  return children
+
+def __get_element(ref):
+  if not ref or len(ref) < 3: return [False, None] # Placeholders such as ANYHL7SEGMENT have no definition
+  return [ref[0] == 'leaf', ref[2]]
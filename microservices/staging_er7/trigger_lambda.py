@@ -1,45 +1,120 @@
-import json, logging, boto3
+import json, logging
 import random
 import os
+import startup, log_util, metrics
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+import er7_batch, er7_view
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(log_util.level)
 
-sf = boto3.client('stepfunctions')
-sns = boto3.client('sns')
+# Created on first use, the step function client is not needed when staging runs in-process
+sf = startup.client('stepfunctions')
+sns = startup.client('sns')
 
+max_workers = int(os.environ.get('max_workers', '10')) # Concurrent staging executions
+max_in_flight = int(os.environ.get('batch_max_in_flight', '100')) # Messages of a batch file read ahead of publishing
+PUBLISH_BATCH_SIZE = 10 # Most entries SNS accepts in one PublishBatch call
+PUBLISH_BATCH_BYTES = 262144 # Most bytes SNS accepts across all entries of one PublishBatch call
+
+# 'step_function' runs the staging steps through the state machine, 'in_process' chains them in this function
+staging_mode = os.environ.get('staging_mode', 'step_function')
+if staging_mode == 'in_process': import staging_pipeline
+
+@startup.handler
 def lambda_handler(event, lambda_context):
-  # Get data that was passed from SNS
-  input_data = {
-    'MessageId': event['Records'][0]['Sns']['MessageId'],
-    'Message':event['Records'][0]['Sns']['Message'],
-    'MessageAttributes': event['Records'][0]['Sns']['MessageAttributes']
-  }
-  logger.info(input_data)
+  # Batch files are given directly ({"bucket": ..., "key": ...}), by EventBridge or through S3 event notifications
+  if 'key' in event: return __handle_batch_file(event['bucket'], event['key'])
+  if event.get('source') == 'aws.s3': # Keys are URL encoded like in S3 event notifications
+    return __check_batch_files([__handle_batch_file(event['detail']['bucket']['name'],
+      unquote_plus(event['detail']['object']['key']))])[0]
+  if event['Records'] and 's3' in event['Records'][0]:
+    return __check_batch_files([__handle_batch_file(r['s3']['bucket']['name'], unquote_plus(r['s3']['object']['key']))
+      for r in event['Records']])
+
+  # Get data that was passed from SNS, one entry per record in the delivery
+  records = [{
+    'MessageId': record['Sns']['MessageId'],
+    'Message': record['Sns']['Message'],
+    'MessageAttributes': record['Sns']['MessageAttributes']
+  } for record in event['Records']]
+  logger.info("Received {} record(s)".format(len(records)))
+
+  # Invoke our parser for all records at once, with a bounded number of executions in flight
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(records)) or 1) as executor:
+    results = list(executor.map(__execute, records))
+
+  # Publish to pub-sub-hub, only records that went through staging
+  failed_ids = [r['MessageId'] for r, entry in zip(records, results) if entry is None]
+  failed_ids += __publish([entry for entry in results if entry is not None])
+
+  # SNS invokes the function asynchronously and ignores what it returns, the invocation has to fail for Lambda
+  # to retry the delivery and then hand it to the dead-letter queue or failure destination
+  if failed_ids:
+    raise Exception("Failed to process {} of {} record(s): {}".format(len(failed_ids), len(records), failed_ids))
+
+# Streams the messages of an HL7 batch file through staging and publishing, reporting a status for each of them
+def __handle_batch_file(bucket, key):
+  logger.info("Reading batch file '{}' from bucket '{}'".format(key, bucket))
+  summary = {}
+  messages = er7_batch.iter_messages(er7_batch.iter_segments(er7_batch.read_s3(bucket, key)), summary)
+  execute = lambda position, er7: __execute({'MessageId': str(position), 'Message': er7, 'Source': key})
+  statuses = list(er7_batch.run(messages, execute, __publish, max_workers, max_in_flight))
+
+  counts = Counter(status['status'] for status in statuses)
+  trailers_match = er7_batch.check_trailers(summary)
+  if not trailers_match: logger.warning("Batch file '{}' does not match its trailer counts: {}".format(key, summary))
+  logger.info("Batch file '{}': {}".format(key, dict(counts)))
+
+  return dict(summary, bucket=bucket, key=key, counts=dict(counts), trailers_match=trailers_match, results=statuses)
 
-  # Invoke our parser
-  response = sf.start_sync_execution(
-    stateMachineArn=os.environ['state_machine'],
-    input= json.dumps({'Message': input_data['Message']})
-  )
+# EventBridge and S3 invoke the function asynchronously and ignore what it returns, like SNS
+def __check_batch_files(files):
+  failed = ["{} ({})".format(f['key'], f['counts']['failed']) for f in files if f['counts'].get('failed')]
+  if failed: raise Exception("Failed to process messages of batch file(s): {}".format(", ".join(failed)))
+  return files
+
+def __execute(input_data):
+  log_util.log_payload(logger, 'trigger', "Staging record '{}'".format(input_data['MessageId']),
+    input_data['Message'])
+  # Batch files are one source, their keys would make a dimension value per file
+  source = 'batch' if 'Source' in input_data else input_data['MessageAttributes'].get('source', {}).get('Value')
+  dimensions = {'source': source, 'message_type': er7_view.get_message_type(input_data['Message'])}
+  metrics.add('message_bytes', len(input_data['Message'].encode()), 'Bytes', **dimensions)
+
+  try:
+    with metrics.timed('staging', **dimensions):
+      if staging_mode == 'in_process':
+        response = staging_pipeline.run(input_data['Message'])
+      else:
+        response = sf.start_sync_execution(
+          stateMachineArn=os.environ['state_machine'],
+          input= json.dumps({'Message': input_data['Message']})
+        )
+  except Exception as e:
+    logger.error("Unable to start execution for record '{}': {}".format(input_data['MessageId'], e))
+    metrics.count('failed', **dimensions)
+    return None
   status = response['status']
 
   if status == 'SUCCEEDED':
     msg = response['output']
     state = 'staged'
     format_type = 'json'
-    logger.info(status)
-  elif status == 'FAILED':
+    logger.debug(status)
+  else: # FAILED or TIMED_OUT
     msg = response['input']
     state = 'error'
     format_type = "txt"
-    logger.warn(response['error'])
+    logger.warning(response.get('error', status))
+  metrics.count(state, **dimensions)
 
-  # Publish to pub-sub-hub
-  sns.publish(
-    TopicArn=os.environ['topic'],
-    Message=msg,
-    MessageAttributes={
+  return {
+    'Id': input_data['MessageId'],
+    'Message': msg,
+    'MessageAttributes': {
       'event': {
         'DataType': 'String',
         'StringValue': state,
@@ -54,8 +129,47 @@ def lambda_handler(event, lambda_context):
       },
       'source': {
         'DataType': 'String',
-        'StringValue': input_data['MessageId'], 
+        'StringValue': input_data.get('Source', input_data['MessageId']),
       }
     }
-  )
-  logger.info("Published to SNS topic")
\ No newline at end of file
+  }
+
+# Publishes entries in batches and returns the ids of the ones that could not be published
+def __publish(entries):
+  failed_ids = []
+
+  for batch in __get_batches(entries):
+    try:
+      with metrics.timed('publish'):
+        response = sns.publish_batch(TopicArn=os.environ['topic'], PublishBatchRequestEntries=batch)
+    except Exception as e:
+      logger.error("Unable to publish batch to SNS topic: {}".format(e))
+      failed_ids += [entry['Id'] for entry in batch]
+      continue
+
+    for failure in response.get('Failed', []):
+      logger.error("Unable to publish record '{}': {}".format(failure['Id'], failure.get('Message')))
+      failed_ids.append(failure['Id'])
+    logger.info("Published {} record(s) to SNS topic".format(len(response.get('Successful', []))))
+
+  return failed_ids
+
+# Groups entries up to the SNS limits on count and total size of a batch
+def __get_batches(entries):
+  batch, batch_bytes = [], 0
+  for entry in entries:
+    entry_bytes = __get_size(entry)
+    if batch and (len(batch) == PUBLISH_BATCH_SIZE or batch_bytes + entry_bytes > PUBLISH_BATCH_BYTES):
+      yield batch
+      batch, batch_bytes = [], 0
+    batch.append(entry)
+    batch_bytes += entry_bytes
+  if batch: yield batch
+
+def __get_size(entry):
+  size = len(entry['Message'].encode())
+  for name, attribute in entry['MessageAttributes'].items():
+    size += len(name.encode()) + len(attribute['DataType'].encode()) + len(attribute['StringValue'].encode())
+  return size
+
+startup.ready()
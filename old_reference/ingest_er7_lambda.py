@@ -1,73 +1,195 @@
-import boto3, json, os, logging, base64, hashlib
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+import json, os, logging, base64, hashlib
+from collections import OrderedDict
+from concurrent.futures import wait
+from datetime import datetime, timedelta, timezone
+import startup # Packaged from microservices/staging_er7, imported first so the init time covers the rest
+import log_util, metrics # Packaged from microservices/staging_er7
+with startup.timed('import:boto3'):
+  import boto3
+import dedup_cache, idempotency, payload # Packaged from microservices/front_door
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(log_util.level)
 
-# Initialize clients outside of the main function to reuse between calls
-sns = boto3.client('sns')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['table'])
-cognito_identity = boto3.client('cognito-identity')
-sf = boto3.client('stepfunctions')
+# Clients are reused between calls and created on first use, as each mode only needs some of them
+sns = startup.client('sns')
+dynamodb = startup.resource('dynamodb')
+table = startup.table(os.environ['table'])
+cognito_identity = startup.client('cognito-identity')
+sf = startup.client('stepfunctions')
+s3 = startup.client('s3')
+lambda_client = startup.client('lambda')
+startup.preload(table) # Every request starts with the message table
 
+# 'sync' parses and publishes before answering, 'async' answers 202 once the message is stored and
+# processes it in a separate asynchronous invocation of this function
+ingest_mode = os.environ.get('ingest_mode', 'sync')
+ACCEPTED = 'accepted'
+ERROR = 'error'
+
+# Credentials and the clients built from them, kept in the warm container and keyed by identity pool and token
+credential_cache = OrderedDict() # Least recently used first
+credential_cache_size = int(os.environ.get('credential_cache_size', '100'))
+credential_refresh = timedelta(seconds=int(os.environ.get('credential_refresh_seconds', '300'))) # Refresh this long before expiry
+credential_cache_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+@startup.handler
 def lambda_handler(event, context):
+  if 'process' in event: return __process_message(event['process'])
+  if event['requestContext']['http']['method'] == 'GET': return __get_status(event)
+
   idToken = event['headers']['authorization']
   claims = event['requestContext']['authorizer']['jwt']['claims']
   source = claims.get('custom:write','')
   
   if len(source) == 0:
     logger.warn("Unauthorized write attempt rejected")
+    metrics.count('unauthorized')
     return __get_response("", 403, "Insufficient privileges to write")
     
-  logger.debug("Source: "+source) 
+  logger.debug("Source: %s", source)
 
-  # Verify the payload is unique through the SHA256[:12] of B64 message (mId)
+  # Verify the payload is unique through the SHA256[:12] of the ER7 message (mId)
   logger.debug("Checking that message is unique")
   body = json.loads(event["body"]) # Body is a JSON payload passed in
   msg = body['msg']
-  msg_hash = hashlib.sha256(msg.encode()).hexdigest()[:12]
-  logger.debug("Message hash: "+msg_hash)
+  msg_hash = payload.get_hash(msg.encode())[:12]
+  logger.debug("Message hash: %s", msg_hash)
+  metrics.add('message_bytes', len(msg), 'Bytes', source=source)
 
-  count = table.query(
-    KeyConditionExpression=Key('source').eq(source) & Key('message_id').eq(msg_hash)
-  )['Count']
-    
-  if count > 0:
+  # One conditional write claims the message, copies sent at the same time or before find it taken
+  cache_key = source + "/" + msg_hash
+  item_key = {'source': source, 'message_id': msg_hash}
+  key = "source={}/protocol=hl7v2/format=er7/zone=ingest/{}.txt".format(source, msg_hash)
+  if dedup_cache.check(cache_key) == dedup_cache.SEEN:
+    holder = {}
+  else:
+    with metrics.timed('dedup_claim', source=source):
+      holder = idempotency.claim(table, item_key, bucket=os.environ['bucket_name'], key=key, state=ACCEPTED)
+
+  if holder is not None:
+    if idempotency.get_state(holder) == idempotency.COMPLETED: dedup_cache.confirm(cache_key)
     logger.warn("Duplicate payload rejected")
+    metrics.count('duplicate', source=source)
     return __get_response(msg_hash, 400, "Rejected due to being a duplicate")
-    
+
   logger.debug("Message {} is unique".format(msg_hash))
+  if ingest_mode == 'async': return __accept_message(context, idToken, msg, key, item_key, source, cache_key)
+
+  # Invoke our parser, the user's credentials are exchanged in the meantime
+  client = startup.get_executor().submit(__get_user_client, idToken)
+  try:
+    state, json_msg = __parse(msg, source)
+    # Store the message (after parsing attempt since we want that status on the tags)
+    tags = 'source={}&state={}'.format(source, state)
+    __put_object(client.result(), msg, key, tags, source)
+  except Exception:
+    wait([client])
+    idempotency.fail(table, item_key, state=ERROR) # Let the sender try again
+    raise
+  logger.info("Message written to bucket '{}' with key '{}'".format(os.environ['bucket_name'], key))
+
+  # The entry and the topic are updated at the same time once the object is stored
+  __publish_and_complete(msg, state, json_msg, key, item_key, source)
+  dedup_cache.add(cache_key)
+  metrics.count(state, source=source)
+  if state == 'parsed':
+    return __get_response(msg_hash, 201, 'Message added and parsed')
+  else:
+    return __get_response(msg_hash, 400, 'Message added, but could not be parsed')
 
-  # Invoke our parser
-  response = sf.start_sync_execution(
-    stateMachineArn=os.environ['state_machine'],
-    input= json.dumps({'Message':msg})
+# Stores the message and hands it to an asynchronous invocation, the sender polls for the outcome
+def __accept_message(context, idToken, msg, key, item_key, source, cache_key):
+  tags = 'source={}&state={}'.format(source, ACCEPTED)
+  try:
+    __put_object(__get_user_client(idToken), msg, key, tags, source)
+    logger.info("Message written to bucket '{}' with key '{}'".format(os.environ['bucket_name'], key))
+
+    # Lambda queues asynchronous invocations and retries them if processing fails
+    with metrics.timed('invoke', source=source):
+      lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'process': dict(item_key, key=key)})
+      )
+  except Exception:
+    idempotency.fail(table, item_key, state=ERROR) # Let the sender try again
+    raise
+
+  # Once queued the message is the asynchronous invocation's, state stays accepted until it is processed
+  idempotency.complete(table, item_key, state=ACCEPTED)
+  dedup_cache.add(cache_key)
+  metrics.count(ACCEPTED, source=source)
+
+  return __get_response(item_key['message_id'], 202, 'Message accepted')
+
+def __process_message(request):
+  db_key = {'source': request['source'], 'message_id': request['message_id']}
+  item = table.get_item(Key=db_key).get('Item')
+  if item is None or item.get('state') != ACCEPTED:
+    logger.info("Message {} was already processed".format(request['message_id'])) # Retried invocation
+    return
+
+  with metrics.timed('s3_get', source=request['source']):
+    msg = s3.get_object(Bucket=os.environ['bucket_name'], Key=request['key'])['Body'].read().decode('utf-8')
+  state, json_msg = __parse(msg, request['source'])
+
+  s3.put_object_tagging(
+    Bucket=os.environ['bucket_name'],
+    Key=request['key'],
+    Tagging={'TagSet': [{'Key': 'source', 'Value': request['source']}, {'Key': 'state', 'Value': state}]}
   )
+  __publish_result(msg, state, json_msg, request['key'], request['source'])
+
+  table.update_item(
+    Key=db_key,
+    UpdateExpression='SET #state = :state',
+    ExpressionAttributeNames={'#state': 'state'},
+    ExpressionAttributeValues={':state': state}
+  )
+  logger.info("Message {} processed with state '{}'".format(request['message_id'], state))
+  metrics.count(state, source=request['source'])
+
+# Lets senders poll for the state of their own messages
+def __get_status(event):
+  claims = event['requestContext']['authorizer']['jwt']['claims']
+  source = claims.get('custom:write','')
+  msg_hash = (event.get('pathParameters') or {}).get('message_id') or \
+    (event.get('queryStringParameters') or {}).get('message_id', '')
+
+  if len(source) == 0:
+    logger.warn("Unauthorized status request rejected")
+    return __get_response(msg_hash, 403, "Insufficient privileges to read the status")
+
+  item = table.get_item(Key={'source': source, 'message_id': msg_hash}).get('Item') if msg_hash else None
+  if item is None:
+    return __get_response(msg_hash, 404, "Message not found")
+
+  return __get_response(msg_hash, 200, item.get('state', 'parsed')) # Older entries were only written once parsed
+
+def __parse(msg, source):
+  with metrics.timed('staging', source=source):
+    response = sf.start_sync_execution(
+      stateMachineArn=os.environ['state_machine'],
+      input= json.dumps({'Message':msg})
+    )
   status = response['status']
-  logger.info(response)
+  logger.info("Staging execution %s", status)
   
   if status == 'SUCCEEDED':
-    state = "parsed"
     json_msg = json.loads(response['output'])['json']
-    logger.info("JSON: {}".format(json_msg))
+    log_util.log_payload(logger, 'ingest', "Parsed message", json_msg)
+    return "parsed", json_msg
   else:
-    state = "error"
     logger.warn(json.loads(response['cause'])['errorMessage'])
+    return "error", None
 
-  # Store the message (after parsing attempt since we want that status on the tags)
-  key = "source={}/protocol=hl7v2/format=er7/zone=ingest/{}.txt".format(source, msg_hash)
-  tags = 'source={}&state={}'.format(source, state)
-  __store_message(idToken, msg, key, tags, msg_hash, source)
-  logger.info("Message written to bucket '{}' with key '{}'".format(os.environ['bucket_name'], key))
-  
-  if status == 'SUCCEEDED':
-    __publish_to_topic(json.dumps(json_msg), 'json', state, key)
-    return __get_response(msg_hash, 201, 'Message added and parsed')
-  else:
-    __publish_to_topic(msg, 'unknown', state, key)
-    return __get_response(msg_hash, 400, 'Message added, but could not be parsed')
+def __publish_result(msg, state, json_msg, key, source):
+  with metrics.timed('publish', source=source):
+    if state == 'parsed':
+      __publish_to_topic(json.dumps(json_msg), 'json', state, key)
+    else:
+      __publish_to_topic(msg, 'unknown', state, key)
   logger.info("Published to SNS topic")
   
 def __get_response(msgId, code, description):
@@ -125,36 +247,45 @@ def __publish_to_topic(msg, format, state, key):
     }
   )
 
-def __store_message(idToken, msg, key, tags, msg_hash, source):
+# Client with user credentials
+def __get_user_client(idToken):
   logger.debug("Getting user credentials")
-  credentials = __get_credentials(
+  return __get_cached_client(
+    's3',
     os.environ['user_pool_id'], 
     os.environ['identity_pool_id'], 
     os.environ['cognito_endpoint'], 
     idToken
   )
-  
-  client = __get_client('s3', credentials) # Client with user credentials
-  
+
+# Publishes the result while the claim is completed. If publishing fails the claim is released once the
+# completion has landed, so the sender can try again; a claim that cannot be completed lapses with its lease.
+def __publish_and_complete(msg, state, json_msg, key, item_key, source):
+  completing = startup.get_executor().submit(__complete, item_key, source, state)
+  try:
+    __publish_result(msg, state, json_msg, key, source)
+  except Exception:
+    wait([completing])
+    idempotency.fail(table, item_key, state=ERROR)
+    raise
+
+  if completing.exception() is not None:
+    logger.error("Unable to complete the claim of message %s: %s", item_key['message_id'], completing.exception())
+
+def __complete(item_key, source, state):
+  with metrics.timed('dedup_complete', source=source):
+    idempotency.complete(table, item_key, state=state)
+
+def __put_object(client, msg, key, tags, source):
   logger.debug("Putting in the bucket")
-  client.put_object(
-    Bucket=os.environ['bucket_name'],
-    Key=key,
-    Body=msg,
-    ContentType="text/plain; charset=utf-8",
-    Tagging=tags
-  )
-  
-   # Update DynamoDB message table
-  logger.debug("Writing to our DynamoDB table")
-  table.put_item(
-    Item={
-      'source': source,
-      'message_id': msg_hash,
-      'bucket': os.environ['bucket_name'],
-      'key': key
-    }
-  )
+  with metrics.timed('s3_put', source=source):
+    client.put_object(
+      Bucket=os.environ['bucket_name'],
+      Key=key,
+      Body=msg,
+      ContentType="text/plain; charset=utf-8",
+      Tagging=tags
+    )
 
 def __get_client(service, credentials):
   client = boto3.client(
@@ -163,4 +294,37 @@ def __get_client(service, credentials):
     aws_secret_access_key=credentials['SecretKey'],
     aws_session_token=credentials['SessionToken']
   )
-  return client
\ No newline at end of file
+  return client
+
+# Reuses the credentials and client of a token until shortly before the credentials expire
+def __get_cached_client(service, userPoolId, identityPoolId, cognitoEndpoint, idToken):
+  key = hashlib.sha256("{}/{}".format(identityPoolId, idToken).encode()).hexdigest() # Keep tokens out of memory dumps
+  entry = credential_cache.get(key)
+
+  if entry is not None and entry['refresh_at'] <= datetime.now(timezone.utc):
+    del credential_cache[key]
+    credential_cache_stats['expired'] += 1
+    entry = None
+
+  if entry is None:
+    credential_cache_stats['misses'] += 1
+    with metrics.timed('credentials'):
+      credentials = __get_credentials(userPoolId, identityPoolId, cognitoEndpoint, idToken)
+    entry = {'credentials': credentials, 'clients': {}, 'refresh_at': credentials['Expiration'] - credential_refresh}
+    credential_cache[key] = entry
+
+    # Drop the least recently used identities beyond the size bound
+    while len(credential_cache) > credential_cache_size:
+      credential_cache.popitem(last=False)
+      credential_cache_stats['evicted'] += 1
+  else:
+    credential_cache_stats['hits'] += 1
+    credential_cache.move_to_end(key)
+
+  if service not in entry['clients']:
+    entry['clients'][service] = __get_client(service, entry['credentials'])
+
+  logger.debug("Credential cache: %s", credential_cache_stats)
+  return entry['clients'][service]
+
+startup.ready()
@@ -42,6 +42,19 @@ def sendRequest(idToken, url, msg, encoding):
   j_resp = json.loads(resp.text)
   return json.dumps(j_resp, indent=2)
 
+def sendBatchRequest(idToken, url, msgs, encoding):
+  headers = { 
+    'Authorization': idToken, 
+    'Content-Type': "application/json"
+  }
+
+  data = json.dumps([encodeToBase64(msg, encoding) for msg in msgs])
+
+  resp = requests.post(url, headers=headers, data=data, verify=True)
+  
+  j_resp = json.loads(resp.text)
+  return json.dumps(j_resp, indent=2)
+
 def main():
   # Get the arguments
   parser = argparse.ArgumentParser()
@@ -54,6 +67,7 @@ def main():
 
   # Pull data from our stacks
   url = cf_util.get_output_value(front_door_stack_name, "PostEr7RouteUrl")
+  batch_url = cf_util.get_output_value(front_door_stack_name, "PostEr7BatchRouteUrl")
   app_client_id = cf_util.get_physical_resource_id(front_door_stack_name, "UserPoolClient")
 
   users = ["admin@example.com","reader@example.com","writer@example.com"]
@@ -82,5 +96,10 @@ PV1|1|O|1001^2002^01||||123456^DOCTOR^BOB^T^^DR|||||||ADM|A0|""".format(rand_num
       response = sendRequest(idToken, url, msg, 'utf-8')
       print (response)
 
+    # Send them all again in one call, they should all be reported as duplicates
+    print ("Send batch")
+    response = sendBatchRequest(idToken, batch_url, msgs, 'utf-8')
+    print (response)
+
 if __name__== "__main__":
   main()
\ No newline at end of file